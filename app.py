@@ -4,7 +4,11 @@ from litestar.middleware import DefineMiddleware
 from auth.components import NamelessSessionAuthMiddleware
 from auth.routes import handlers as auth_handlers
 from fs.routes import handlers as fs_handlers
-from init import init
+import config
+from init import init, shutdown
+from metrics.middleware import MetricsMiddleware
+from metrics.routes import handlers as metrics_handlers, prometheus_config
+from upload.routes import handlers as upload_handlers
 
 fs_router = Router(
     path='/fs',
@@ -16,10 +20,22 @@ auth_router = Router(
     route_handlers=[*auth_handlers]
 )
 
-auth_middleware = DefineMiddleware(NamelessSessionAuthMiddleware, exclude=['/auth/session'])
+upload_router = Router(
+    path='/upload',
+    route_handlers=[*upload_handlers]
+)
+
+auth_middleware = DefineMiddleware(NamelessSessionAuthMiddleware, exclude=['^/auth/session$', '^/metrics$'])
+
+route_handlers = [fs_router, auth_router, upload_router]
+middleware = [auth_middleware]
+if config.METRICS:
+    route_handlers.extend(metrics_handlers)
+    middleware = [prometheus_config.middleware, MetricsMiddleware, *middleware]
 
 app = Litestar(
-    route_handlers=[fs_router, auth_router],
-    middleware=[auth_middleware],
+    route_handlers=route_handlers,
+    middleware=middleware,
     on_startup=[init],
+    on_shutdown=[shutdown],
 )
@@ -1,36 +1,109 @@
+import hashlib
 import time
+from typing import Optional
 
 from litestar.connection import ASGIConnection
 from litestar.exceptions import NotAuthorizedException
 from litestar.middleware import AbstractAuthenticationMiddleware, AuthenticationResult
-from redis import Redis
+from nacl.exceptions import CryptoError
+from redis.asyncio import Redis
 
-from singletons import redis_connection
-from utils import get_decoder
+import config
+from metrics.collectors import AUTH_DECRYPT_TIME, REDIS_TIME, cache_collector
+from singletons import async_redis_connection
+from utils import LRUCache, get_decoder
+
+
+class TokenCache:
+    """
+    Decrypted session id of recently seen bearer tokens,
+    so the sealed box is opened once per token instead of once per request.
+    Tokens are kept by digest only.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = LRUCache(maxsize, ttl)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[str]:
+        return self.entries.get(self._key(token))
+
+    def put(self, token: str, session_id: str) -> None:
+        self.entries.put(self._key(token), session_id)
+
+    def evict_session(self, session_id: str) -> int:
+        return self.entries.pop_where(lambda cached: cached == session_id)
+
+    def stats(self) -> dict:
+        return self.entries.stats()
+
+
+token_cache = TokenCache(config.TOKEN_CACHE_SIZE, config.TOKEN_CACHE_TTL)
+cache_collector.add('token', token_cache.entries)
+
+
+def decrypt_session_id(token: str) -> str:
+    session_id = token_cache.get(token)
+    if session_id is None:
+        with AUTH_DECRYPT_TIME.time():
+            session_id = get_decoder().decrypt(bytes.fromhex(token)).decode()
+        token_cache.put(token, session_id)
+    return session_id
 
 
 class AuthRedisClient:
-    def __init__(self, redis: Redis):
+    """
+    Sessions kept in the `fs-session` redis hash, one field per session with its own expiry.
+    Sessions validated within the last `near_cache_ttl` seconds are trusted without asking redis.
+    """
+
+    def __init__(self, redis: Redis, near_cache_size: int = 10000, near_cache_ttl: float = 5):
         self.redis = redis
+        self.near_cache = LRUCache(near_cache_size, near_cache_ttl)
 
-    def add(self, session_id: str):
+    async def add(self, session_id: str):
         now = time.time_ns()
-        self.redis.hset('fs-session', mapping={
-            session_id: now
-        })
-        self.redis.hexpire('fs-session', 3060, session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset('fs-session', mapping={
+                session_id: now
+            })
+            pipe.hexpire('fs-session', 3060, session_id)
+            with REDIS_TIME.labels('hset').time():
+                await pipe.execute()
+
+    async def remove(self, session_id: str):
+        with REDIS_TIME.labels('hdel').time():
+            await self.redis.hdel('fs-session', session_id)
+        self.near_cache.pop(session_id)
+        token_cache.evict_session(session_id)
 
-    def __contains__(self, session_id):
-        exists = self.redis.hexists('fs-session', session_id)
+    async def contains(self, session_id: str) -> bool:
+        if self.near_cache.get(session_id):
+            return True
+        # refreshing the expiry doubles as the existence check, -2 means no such field
+        with REDIS_TIME.labels('hexpire').time():
+            exists = (await self.redis.hexpire('fs-session', 3600, session_id))[0] == 1
         if exists:
-            self.redis.hexpire('fs-session', 3600, session_id)
+            self.near_cache.put(session_id, True)
         return exists
 
+    async def count(self) -> int:
+        with REDIS_TIME.labels('hlen').time():
+            return await self.redis.hlen('fs-session')
+
     def __str__(self):
-        return f'<AuthRedisClient (Sessions: {self.redis.hlen("fs-session")})>'
+        return f'<AuthRedisClient (Near cache: {len(self.near_cache)})>'
 
 
-session_manager = AuthRedisClient(redis_connection)
+session_manager = AuthRedisClient(
+    async_redis_connection,
+    config.SESSION_CACHE_SIZE,
+    config.SESSION_CACHE_TTL,
+)
+cache_collector.add('session', session_manager.near_cache)
 
 
 class NamelessSessionAuthMiddleware(AbstractAuthenticationMiddleware):
@@ -42,7 +115,10 @@ class NamelessSessionAuthMiddleware(AbstractAuthenticationMiddleware):
             raise NotAuthorizedException()
 
         token = auth_header.split()[1]
-        session_id = get_decoder().decrypt(bytes.fromhex(token)).decode()
-        if not session_id in NamelessSessionAuthMiddleware.authenticated:
+        try:
+            session_id = decrypt_session_id(token)
+        except (CryptoError, ValueError):
+            raise NotAuthorizedException()
+        if not await NamelessSessionAuthMiddleware.authenticated.contains(session_id):
             raise NotAuthorizedException()
         return AuthenticationResult(True, None)
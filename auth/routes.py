@@ -1,11 +1,11 @@
 from typing import Annotated
 
-from litestar import post
+from litestar import post, delete
 from litestar.exceptions import HTTPException
 from litestar.params import Parameter
 from nacl.exceptions import CryptoError
 
-from auth.components import session_manager
+from auth.components import decrypt_session_id, session_manager
 from utils import get_decoder, get_handshake
 
 authenticated = session_manager
@@ -24,10 +24,25 @@ async def create_session(
         handshake, session_id = decrypted.split(':')
         if handshake != get_handshake():
             raise HTTPException(status_code=401)
-        authenticated.add(session_id)
+        await authenticated.add(session_id)
         return None
     except CryptoError:
         raise HTTPException(status_code=401)
 
 
-handlers = [create_session]
+@delete('/session', status_code=204)
+async def revoke_session(
+        bearer: Annotated[str, Parameter(header='Authorization')],
+) -> None:
+    if bearer is None or not bearer.startswith('Bearer '):
+        raise HTTPException(status_code=401)
+
+    token = bearer.split()[1]
+    try:
+        session_id = decrypt_session_id(token)
+    except (CryptoError, ValueError):
+        raise HTTPException(status_code=401)
+    await authenticated.remove(session_id)
+
+
+handlers = [create_session, revoke_session]
@@ -0,0 +1,46 @@
+"""
+Compare two results of bench.run, scenario by scenario.
+
+    python -m bench.compare old.json new.json [--threshold 10]
+
+Prints the change of throughput and of the median latency, and exits with 1 when a scenario
+lost more than `threshold` percent of its requests per second.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def load(path: str) -> dict:
+    report = json.loads(Path(path).read_text())
+    return {(result['scenario'], result['concurrency']): result for result in report['results']}
+
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare two benchmark results')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent of throughput lost that counts as a regression')
+    args = parser.parse_args()
+
+    old, new = load(args.old), load(args.new)
+    regressions = 0
+    print(f'{"scenario":>16} {"c":>4} {"req/s":>18} {"change":>8} {"p50 ms":>20} {"change":>8}')
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        rps = change(before['rps'], after['rps'])
+        p50 = change(before['latency_ms']['p50'], after['latency_ms']['p50'])
+        regressed = rps < -args.threshold
+        regressions += regressed
+        print(f'{key[0]:>16} {key[1]:>4} {before["rps"]:>8} -> {after["rps"]:<7} {rps:>+7.1f}% '
+              f'{before["latency_ms"]["p50"]:>9} -> {after["latency_ms"]["p50"]:<8} {p50:>+7.1f}%'
+              + ('  regression' if regressed else ''))
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f'{key[0]:>16} {key[1]:>4} only in {"old" if key in old else "new"}')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,367 @@
+"""
+Benchmark of the fs API, its results written as JSON so runs can be compared.
+
+    python -m bench.run [--depth 3] [--width 4] [--files 4] [--concurrency 1,8,32] [--requests 200]
+                        [--redis fake|local] [--url http://host:port] [--output results.json]
+
+Without --url the app is served in process, without sockets, against a fresh ROOT_DIR,
+SQLite database and key in a temporary directory, and fakeredis (the `bench` extra)
+unless `--redis local` points it at the redis of REDIS_HOST.
+With --url a running server is measured, KEY_DIR must then hold its key to open sessions.
+Everything a run creates is below a `/bench-<id>` directory, removed at the end.
+
+Scenarios at each concurrency level:
+    listing          full listing of a directory of `--wide` entries
+    listing_page     its first page of 100
+    download         the whole `--large-size` file, MB/s
+    download_range   random `--range-size` slices of it
+    download_small   random small files of the seeded tree
+    upload           new files of `--upload-size`, MB/s
+    auth_cached      a small listing with the same bearer token every time
+    auth_uncached    the same with a new token every time, so each one is decrypted
+and once, one request at a time:
+    rename_deep      renaming the top of the seeded tree, which moves every path below it
+    rmtree           deleting a seeded tree
+
+Compare two runs with `python -m bench.compare old.json new.json`.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def measure(
+        scenario: str,
+        concurrency: int,
+        total: int,
+        request: Callable[[int], Awaitable[int]],
+        **extra,
+) -> dict:
+    """
+    Run `request(i)` for i in range(total) on `concurrency` workers.
+    `request` returns the payload bytes it moved and raises on an unexpected response.
+    """
+    latencies = []
+    errors = 0
+    transferred = 0
+    pending = iter(range(total))
+
+    async def worker():
+        nonlocal errors, transferred
+        for i in pending:
+            started = time.perf_counter()
+            try:
+                transferred += await request(i)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f'{scenario}: {e!r}', file=sys.stderr)
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return summarize(scenario, concurrency, latencies, elapsed, errors, transferred, **extra)
+
+
+def summarize(
+        scenario: str,
+        concurrency: int,
+        latencies: List[float],
+        elapsed: float,
+        errors: int = 0,
+        transferred: int = 0,
+        **extra,
+) -> dict:
+    latencies = sorted(latencies)
+    result = {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0,
+            'p50': round(percentile(latencies, .5) * 1000, 3),
+            'p90': round(percentile(latencies, .9) * 1000, 3),
+            'p99': round(percentile(latencies, .99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3) if latencies else 0,
+        },
+        **extra,
+    }
+    if transferred:
+        result['mb_per_s'] = round(transferred / elapsed / 1024 ** 2, 2)
+    print(f'{scenario:>16} c={concurrency:<4} {result["rps"]:>9} req/s  p50 {result["latency_ms"]["p50"]:>8} ms'
+          + (f'  {result["mb_per_s"]} MB/s' if transferred else ''), file=sys.stderr)
+    return result
+
+
+def check(response, *statuses: int):
+    if response.status_code not in statuses:
+        raise RuntimeError(f'{response.request.method} {response.request.url} {response.status_code}: '
+                           f'{response.text[:200]}')
+    return response
+
+
+class Tokens:
+    """Sealed bearer tokens, made the way clients make them, with the public key in KEY_DIR."""
+
+    def __init__(self, key_dir: Path):
+        from nacl.public import PublicKey, SealedBox
+
+        public_key = PublicKey(bytes.fromhex((key_dir / 'public_key').read_text()))
+        self.box = SealedBox(public_key)
+        self.handshake = (key_dir / 'handshake').read_text()
+
+    def seal(self, message: str) -> str:
+        return self.box.encrypt(message.encode()).hex()
+
+    async def open_session(self, client) -> str:
+        session_id = uuid.uuid4().hex
+        token = self.seal(f'{self.handshake}:{session_id}')
+        check(await client.post('/auth/session', headers={'Authorization': f'Bearer {token}'}), 204)
+        return session_id
+
+
+async def seed_tree(client, headers: dict, path: str, depth: int, width: int, files: int, file_size: int) -> int:
+    """Directories `width` wide and `depth` deep below `path`, with `files` files in each. Returns the objects made."""
+    check(await client.post(f'/fs{path}?isdir', headers=headers), 201)
+    created = 1
+    responses = await asyncio.gather(*(
+        client.post(f'/fs{path}', headers=headers, files={'data': (f'f{i}.bin', os.urandom(file_size))})
+        for i in range(files)
+    ))
+    for response in responses:
+        check(response, 201)
+    created += files
+    if depth > 1:
+        for i in range(width):
+            created += await seed_tree(client, headers, f'{path}/d{i}', depth - 1, width, files, file_size)
+    return created
+
+
+def tree_files(path: str, depth: int, width: int, files: int) -> List[str]:
+    found = [f'{path}/f{i}.bin' for i in range(files)]
+    if depth > 1:
+        for i in range(width):
+            found.extend(tree_files(f'{path}/d{i}', depth - 1, width, files))
+    return found
+
+
+async def run(client, key_dir: Path, args) -> List[dict]:
+    tokens = Tokens(key_dir)
+    session_id = await tokens.open_session(client)
+    headers = {'Authorization': f'Bearer {tokens.seal(session_id)}', 'Accept-Encoding': 'identity'}
+    base = f'/bench-{uuid.uuid4().hex[:8]}'
+    results = []
+    try:
+        started = time.perf_counter()
+        check(await client.post(f'/fs{base}?isdir', headers=headers), 201)
+        tree_size = await seed_tree(client, headers, f'{base}/tree', args.depth, args.width, args.files, args.file_size)
+        check(await client.post(f'/fs{base}/wide?isdir', headers=headers), 201)
+        for i in range(args.wide):
+            check(await client.post(f'/fs{base}/wide/e{i}?isdir', headers=headers), 201)
+        # through a resumable upload, a form upload this large is over the request body limit
+        large = os.urandom(args.large_size)
+        upload = check(await client.post('/upload', headers=headers, json={
+            'full_path': f'{base}/large.bin', 'size': len(large),
+        }), 201).json()
+        check(await client.put(f'/upload/{upload["id"]}/parts/1', headers=headers, content=large), 200)
+        check(await client.post(f'/upload/{upload["id"]}/complete', headers=headers), 201)
+        check(await client.post(f'/fs{base}/uploads?isdir', headers=headers), 201)
+        # paths merely containing an unauthenticated route stay behind auth
+        for path in (f'/fs{base}/metrics', f'/fs{base}/tree/metrics/f0.bin', f'/fs{base}/auth/session'):
+            check(await client.get(path), 401)
+        print(f'seeded {tree_size + args.wide + 3} objects in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        small_files = tree_files(f'{base}/tree', args.depth, args.width, args.files)
+        uploads = 0
+
+        async def listing(_):
+            return len(check(await client.get(f'/fs{base}/wide', headers=headers), 200).content)
+
+        async def listing_page(_):
+            return len(check(await client.get(f'/fs{base}/wide?limit=100', headers=headers), 200).content)
+
+        async def download(_):
+            return len(check(await client.get(f'/fs{base}/large.bin', headers=headers), 200).content)
+
+        async def download_range(_):
+            start = random.randrange(0, max(1, args.large_size - args.range_size))
+            range_header = {'Range': f'bytes={start}-{start + args.range_size - 1}'}
+            return len(check(await client.get(f'/fs{base}/large.bin', headers={**headers, **range_header}), 206).content)
+
+        async def download_small(_):
+            return len(check(await client.get(f'/fs{random.choice(small_files)}', headers=headers), 200).content)
+
+        async def upload(_):
+            nonlocal uploads
+            uploads += 1
+            files = {'data': (f'u{uploads}.bin', os.urandom(args.upload_size))}
+            check(await client.post(f'/fs{base}/uploads', headers=headers, files=files), 201)
+            return args.upload_size
+
+        async def auth_cached(_):
+            check(await client.get(f'/fs{base}/tree/d0', headers=headers), 200)
+            return 0
+
+        for concurrency in args.concurrency:
+            results.append(await measure('listing', concurrency, args.requests, listing, entries=args.wide))
+            results.append(await measure('listing_page', concurrency, args.requests, listing_page, entries=100))
+            results.append(await measure('download', concurrency, args.requests, download, size=args.large_size))
+            results.append(await measure('download_range', concurrency, args.requests, download_range,
+                                         size=args.range_size))
+            results.append(await measure('download_small', concurrency, args.requests, download_small,
+                                         size=args.file_size))
+            results.append(await measure('upload', concurrency, args.requests, upload, size=args.upload_size))
+
+            cached = await measure('auth_cached', concurrency, args.requests, auth_cached)
+            # sealed up front, only opening them is measured
+            fresh = [{**headers, 'Authorization': f'Bearer {tokens.seal(session_id)}'} for _ in range(args.requests)]
+
+            async def auth_uncached(i):
+                check(await client.get(f'/fs{base}/tree/d0', headers=fresh[i]), 200)
+                return 0
+
+            uncached = await measure('auth_uncached', concurrency, args.requests, auth_uncached)
+            uncached['overhead_ms'] = round(uncached['latency_ms']['p50'] - cached['latency_ms']['p50'], 3)
+            results.extend([cached, uncached])
+
+        name = 'tree'
+
+        async def rename_deep(i):
+            nonlocal name
+            new_name = f'tree{i % 2}'
+            check(await client.patch(f'/fs{base}/{name}', headers=headers, json={'name': new_name}), 200)
+            name = new_name
+            return 0
+
+        results.append(await measure('rename_deep', 1, args.rounds, rename_deep, objects=tree_size))
+
+        # seeding each tree to delete is left out of the measure
+        rmtree_times = []
+        for i in range(args.rounds):
+            await seed_tree(client, headers, f'{base}/rm{i}', args.depth, args.width, args.files, 0)
+            started = time.perf_counter()
+            check(await client.delete(f'/fs{base}/rm{i}?rmtree', headers=headers), 204)
+            rmtree_times.append(time.perf_counter() - started)
+        results.append(summarize('rmtree', 1, rmtree_times, sum(rmtree_times), objects=tree_size))
+    finally:
+        await client.delete(f'/fs{base}?rmtree', headers=headers)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_fakeredis():
+    """Swap the redis clients for fakeredis ones sharing one server, before singletons creates them."""
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('fakeredis is not installed (the `bench` extra), or run with --redis local')
+    import redis
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    redis.Redis = lambda *args, decode_responses=False, **kwargs: fakeredis.FakeRedis(
+        server=server, decode_responses=decode_responses)
+    redis.asyncio.Redis = lambda *args, decode_responses=False, **kwargs: fakeredis.FakeAsyncRedis(
+        server=server, decode_responses=decode_responses)
+
+
+async def main(args) -> dict:
+    # a log line per request would be measured too
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if args.url:
+        import httpx
+
+        import config
+
+        key_dir = Path(config.KEY_DIR)
+        async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+            results = await run(client, key_dir, args)
+    else:
+        work_dir = Path(tempfile.mkdtemp(prefix='fs-bench-'))
+        os.environ.update(
+            ROOT_DIR=str(work_dir / 'root'),
+            DB_URL=f'sqlite:///{work_dir / "db.sqlite"}',
+            KEY_DIR=str(work_dir / 'key'),
+            STATE_DIR=str(work_dir / 'state'),
+            RECONCILE_ON_STARTUP='false',
+            GC_INTERVAL='0',
+        )
+        if args.redis == 'fake':
+            use_fakeredis()
+        from litestar.testing import AsyncTestClient
+
+        from app import app
+
+        async with AsyncTestClient(app, timeout=None) as client:
+            results = await run(client, work_dir / 'key', args)
+
+    return {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(args.started)),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.url or f'in process, {args.redis} redis',
+        'params': {
+            key: value for key, value in vars(args).items() if key not in ('output', 'started')
+        },
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the fs API')
+    parser.add_argument('--depth', type=int, default=3, help='levels of the seeded tree')
+    parser.add_argument('--width', type=int, default=4, help='subdirectories of each seeded directory')
+    parser.add_argument('--files', type=int, default=4, help='files in each seeded directory')
+    parser.add_argument('--file-size', type=int, default=16 * 1024, help='bytes of each seeded file')
+    parser.add_argument('--wide', type=int, default=1000, help='entries of the listed directory')
+    parser.add_argument('--large-size', type=int, default=16 * 1024 ** 2, help='bytes of the downloaded file')
+    parser.add_argument('--range-size', type=int, default=1024 ** 2, help='bytes of each range request')
+    parser.add_argument('--upload-size', type=int, default=1024 ** 2, help='bytes of each uploaded file')
+    parser.add_argument('--concurrency', type=lambda value: [int(level) for level in value.split(',')],
+                        default=[1, 8, 32], help='comma separated levels of concurrent requests')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and level')
+    parser.add_argument('--rounds', type=int, default=5, help='repetitions of rename_deep and rmtree')
+    parser.add_argument('--redis', choices=['fake', 'local'], default='fake')
+    parser.add_argument('--url', help='measure the server running there instead')
+    parser.add_argument('--output', help='file for the JSON results, stdout if not given')
+    args = parser.parse_args()
+    args.started = time.time()
+
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + '\n')
+    else:
+        print(report)
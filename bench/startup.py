@@ -0,0 +1,153 @@
+"""
+Boot time of the server, with one and several workers, on a new deployment and on a restart.
+
+    python -m bench.startup [--workers 1,4] [--repeat 3] [--redis fake|local] [--output results.json]
+
+Each boot runs `uvicorn app:app --workers N` against a ROOT_DIR, SQLite database, key and STATE_DIR
+in a temporary directory. `cold` boots start from an empty one, as a first deployment does,
+`warm` boots reuse it, as a restart does. Reported is the time until every worker has
+completed its startup, `first_response_ms` is when the first one answered.
+With `--redis fake` the workers share a fakeredis server listening on a local port (the `bench` extra).
+The JSON has the shape of bench.run results, bench.compare compares it the same way.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from .run import git_commit, summarize
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fakeredis() -> int:
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        raise SystemExit('fakeredis is not installed (the `bench` extra), or run with --redis local')
+    port = free_port()
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return port
+
+
+def boot(work_dir: Path, workers: int, env: dict, timeout: float) -> tuple:
+    """Seconds until the first response and until every worker completed its startup."""
+    port = free_port()
+    env = {
+        **os.environ,
+        **env,
+        'ROOT_DIR': str(work_dir / 'root'),
+        'DB_URL': f'sqlite:///{work_dir / "db.sqlite"}',
+        'KEY_DIR': str(work_dir / 'key'),
+        'STATE_DIR': str(work_dir / 'state'),
+    }
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port), '--workers', str(workers)],
+        cwd=Path(__file__).parent.parent,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    ready = threading.Event()
+    ready_at = []
+
+    def watch():
+        for line in process.stderr:
+            if 'Application startup complete' in line:
+                ready_at.append(time.perf_counter() - started)
+                if len(ready_at) == workers:
+                    ready.set()
+            elif 'Traceback' in line or 'Application startup failed' in line:
+                print(line, end='', file=sys.stderr)
+
+    threading.Thread(target=watch, daemon=True).start()
+    first_response = None
+    try:
+        while first_response is None and time.perf_counter() - started < timeout:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/fs/', timeout=1)
+            except urllib.error.HTTPError:
+                # 401, a worker is answering
+                pass
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(.005)
+                continue
+            first_response = time.perf_counter() - started
+        if not ready.wait(max(0., timeout - (time.perf_counter() - started))):
+            raise RuntimeError(f'{len(ready_at)} of {workers} workers started in {timeout}s')
+        return first_response, ready_at[-1]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(args) -> dict:
+    env = {'RECONCILE_ON_STARTUP': 'true', 'GC_INTERVAL': '0'}
+    if args.redis == 'fake':
+        env.update(REDIS_HOST='127.0.0.1', REDIS_PORT=str(start_fakeredis()), REDIS_PASS='')
+
+    results = []
+    for workers in args.workers:
+        for state in ('cold', 'warm'):
+            times, first_responses = [], []
+            for _ in range(args.repeat):
+                work_dir = Path(tempfile.mkdtemp(prefix='fs-bench-startup-'))
+                try:
+                    if state == 'warm':
+                        boot(work_dir, workers, env, args.timeout)
+                    first_response, all_ready = boot(work_dir, workers, env, args.timeout)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                times.append(all_ready)
+                first_responses.append(first_response)
+            results.append(summarize(
+                f'startup_{state}', workers, times, sum(times),
+                first_response_ms=round(min(first_responses) * 1000, 3),
+            ))
+
+    return {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(args.started)),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': f'uvicorn, {args.redis} redis',
+        'params': {
+            key: value for key, value in vars(args).items() if key not in ('output', 'started')
+        },
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the boot time of the server')
+    parser.add_argument('--workers', type=lambda value: [int(level) for level in value.split(',')],
+                        default=[1, 4], help='comma separated worker counts')
+    parser.add_argument('--repeat', type=int, default=3, help='boots per worker count and state')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a boot may take')
+    parser.add_argument('--redis', choices=['fake', 'local'], default='fake')
+    parser.add_argument('--output', help='file for the JSON results, stdout if not given')
+    args = parser.parse_args()
+    args.started = time.time()
+
+    report = json.dumps(main(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + '\n')
+    else:
+        print(report)
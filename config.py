@@ -5,9 +5,46 @@ from dotenv import load_dotenv
 load_dotenv()
 ROOT_DIR = os.environ.get('ROOT_DIR', '.')
 DB_URL = os.environ.get('DB_URL', 'sqlite:///test.sqlite')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 500))
 KEY_DIR = os.environ.get('KEY_DIR', '.key')
+STATE_DIR = os.environ.get('STATE_DIR', '.state')
+DEDUPE = os.environ.get('DEDUPE', 'false').lower() in ('1', 'true', 'yes')
+SHARD_DEPTH = int(os.environ.get('SHARD_DEPTH', 0))
+SHARD_WIDTH = int(os.environ.get('SHARD_WIDTH', 2))
 
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
 REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 REDIS_USER = os.environ.get('REDIS_USER', 'default')
 REDIS_PASS = os.environ.get('REDIS_PASS', 'systempass')
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+STREAM_MAX_CHUNK_SIZE = int(os.environ.get('STREAM_MAX_CHUNK_SIZE', 1024 * 1024))
+IO_THREADS = int(os.environ.get('IO_THREADS', 40))
+LISTING_CACHE_SIZE = int(os.environ.get('LISTING_CACHE_SIZE', 1024))
+LISTING_PAGE_SIZE = int(os.environ.get('LISTING_PAGE_SIZE', 1000))
+COMPRESS = os.environ.get('COMPRESS', 'true').lower() in ('1', 'true', 'yes')
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+BLOB_CACHE_SIZE = int(os.environ.get('BLOB_CACHE_SIZE', 64 * 1024 * 1024))
+BLOB_CACHE_MAX_FILE_SIZE = int(os.environ.get('BLOB_CACHE_MAX_FILE_SIZE', 256 * 1024))
+BLOB_CACHE_ADMIT_AFTER = int(os.environ.get('BLOB_CACHE_ADMIT_AFTER', 2))
+BLOB_CACHE_MMAP_MIN_SIZE = int(os.environ.get('BLOB_CACHE_MMAP_MIN_SIZE', 64 * 1024))
+UPLOAD_MAX_PART_SIZE = int(os.environ.get('UPLOAD_MAX_PART_SIZE', 5 * 1024 ** 3))
+UPLOAD_TTL = float(os.environ.get('UPLOAD_TTL', 7 * 86400))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 5))
+RECONCILE_ON_STARTUP = os.environ.get('RECONCILE_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+RECONCILE_BATCH_SIZE = int(os.environ.get('RECONCILE_BATCH_SIZE', 1000))
+GC_INTERVAL = float(os.environ.get('GC_INTERVAL', 0))
+GC_GRACE_PERIOD = float(os.environ.get('GC_GRACE_PERIOD', 86400))
+GC_RATE = float(os.environ.get('GC_RATE', 100))
+GC_SCAN_RATE = float(os.environ.get('GC_SCAN_RATE', 10000))
+GC_BATCH_SIZE = int(os.environ.get('GC_BATCH_SIZE', 1000))
+METRICS = os.environ.get('METRICS', 'true').lower() in ('1', 'true', 'yes')
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(STATE_DIR, 'profiles'))
@@ -0,0 +1,189 @@
+"""
+zip and tar archives of a directory tree, built while they are sent.
+Nothing is written to disk and at most one chunk of a file is held in memory,
+only the zip central directory grows with the number of entries.
+"""
+import struct
+import tarfile
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Optional
+
+from utils import file_streamer, get_mime_type, run_io
+
+# contents that deflate would only spend time on
+COMPRESSED_TYPES = (
+    'image/', 'audio/', 'video/',
+    'application/zip', 'application/gzip', 'application/x-7z-compressed', 'application/x-bzip2',
+    'application/x-rar-compressed', 'application/x-xz', 'application/zstd', 'application/pdf',
+)
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_UTF8 = 0x800
+ZIP_DATA_DESCRIPTOR = 0x08
+ZIP_DEFLATED = 8
+ZIP_STORED = 0
+
+
+@dataclass
+class ArchiveEntry:
+    # '/' separated path inside the archive, without a trailing slash
+    name: str
+    modified_at: datetime
+    # physical file, None for a directory
+    path: Optional[Path] = None
+
+    @property
+    def is_dir(self) -> bool:
+        return self.path is None
+
+
+async def _stat(path: Path):
+    try:
+        return await run_io(path.stat)
+    except FileNotFoundError:
+        print(f'{path} is missing, left out of the archive')
+        return None
+
+
+def _dos_time(moment: datetime):
+    moment = max(moment, datetime(1980, 1, 1, tzinfo=moment.tzinfo))
+    return (
+        (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2),
+        ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day,
+    )
+
+
+async def zip_stream(
+        entries: AsyncIterable[ArchiveEntry],
+        store: bool = False,
+        level: int = 6,
+) -> AsyncIterator[bytes]:
+    """
+    Stream a zip archive of `entries`.
+    Sizes and checksums are only known once an entry is written, so they follow it
+    in a data descriptor. Entries are deflated unless `store` is set or their type
+    is already compressed, ZIP64 records are used where sizes or offsets need them.
+    """
+    offset = 0
+    central_directory = []
+    async for entry in entries:
+        size = 0
+        if not entry.is_dir:
+            stat = await _stat(entry.path)
+            if stat is None:
+                continue
+            size = stat.st_size
+        name = (entry.name + '/' if entry.is_dir else entry.name).encode()
+        deflate = not (store or entry.is_dir or get_mime_type(entry.name).startswith(COMPRESSED_TYPES))
+        method = ZIP_DEFLATED if deflate else ZIP_STORED
+        # deflate may grow incompressible data a little, keep a margin
+        zip64 = size > ZIP64_LIMIT // 2
+        dos_time, dos_date = _dos_time(entry.modified_at)
+        flags = ZIP_UTF8 | ZIP_DATA_DESCRIPTOR
+        version = 45 if zip64 else 20
+
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        placeholder = ZIP64_LIMIT if zip64 else 0
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, flags, method, dos_time, dos_date,
+            0, placeholder, placeholder, len(name), len(extra),
+        ) + name + extra
+        header_offset = offset
+        yield header
+        offset += len(header)
+
+        crc, compressed_size = 0, 0
+        if not entry.is_dir:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if deflate else None
+            async for chunk in file_streamer(entry.path):
+                crc = zlib.crc32(chunk, crc)
+                if compressor:
+                    chunk = await run_io(compressor.compress, chunk)
+                if chunk:
+                    compressed_size += len(chunk)
+                    yield chunk
+            if compressor:
+                chunk = compressor.flush()
+                compressed_size += len(chunk)
+                yield chunk
+        offset += compressed_size
+
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+        yield descriptor
+        offset += len(descriptor)
+
+        zip64_fields = []
+        if zip64:
+            zip64_fields += [size, compressed_size]
+        if header_offset >= ZIP64_LIMIT:
+            zip64_fields.append(header_offset)
+        extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+        mode = (0o40755 << 16) | 0x10 if entry.is_dir else 0o100644 << 16
+        central_directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, max(version, 45 if zip64_fields else 20),
+            flags, method, dos_time, dos_date, crc,
+            ZIP64_LIMIT if zip64 else compressed_size,
+            ZIP64_LIMIT if zip64 else size,
+            len(name), len(extra), 0, 0, 0, mode,
+            min(header_offset, ZIP64_LIMIT),
+        ) + name + extra)
+
+    directory_offset = offset
+    directory_size = 0
+    for record in central_directory:
+        yield record
+        directory_size += len(record)
+
+    count = len(central_directory)
+    if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        end_offset = directory_offset + directory_size
+        yield struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+            count, count, directory_size, directory_offset,
+        )
+        yield struct.pack('<IIQI', 0x07064b50, 0, end_offset, 1)
+    yield struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0,
+    )
+
+
+async def tar_stream(entries: AsyncIterable[ArchiveEntry]) -> AsyncIterator[bytes]:
+    """
+    Stream a POSIX (pax) tar archive of `entries`, stored as is.
+    The size in each header is taken when the entry starts; should the file
+    shrink while it is read, the entry is padded to keep the archive readable.
+    """
+    async for entry in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.mtime = int(entry.modified_at.timestamp())
+        if entry.is_dir:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            stat = await _stat(entry.path)
+            if stat is None:
+                continue
+            info.size = stat.st_size
+            info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        if entry.is_dir:
+            continue
+
+        sent = 0
+        if info.size:
+            async for chunk in file_streamer(entry.path, 0, info.size - 1):
+                sent += len(chunk)
+                yield chunk
+        if sent < info.size:
+            print(f'{entry.path} shrank while archived, padded')
+            yield bytes(info.size - sent)
+        if info.size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield bytes(tarfile.BLOCKSIZE * 2)
@@ -0,0 +1,230 @@
+import json
+import mmap
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+
+from metrics.collectors import REDIS_TIME
+from utils import LRUCache
+from .models import FSObjectDto
+
+
+class ListingCache:
+    """
+    Directory listings by directory id, kept per worker.
+    Entries are stored with the directory version they were built from,
+    and invalidations are broadcast over redis so every worker drops them.
+    They are published with `async_redis`, the blocking `redis` client only serves the listener thread.
+    """
+
+    channel = 'fs-listing-invalidate'
+
+    def __init__(self, maxsize: int, redis: Optional[Redis] = None, async_redis: Optional[AsyncRedis] = None):
+        self.entries = LRUCache(maxsize)
+        self.redis = redis
+        self.async_redis = async_redis
+        self.origin = uuid.uuid4().hex
+        self._listener = None
+
+    def get(self, dir_id: int, version: int) -> Optional[List[FSObjectDto]]:
+        cached = self.entries.get(dir_id)
+        if cached is None:
+            return None
+        cached_version, listing = cached
+        if cached_version != version:
+            # changed by a worker whose invalidation has not arrived yet
+            self.entries.pop(dir_id)
+            return None
+        return listing
+
+    def put(self, dir_id: int, version: int, listing: List[FSObjectDto]) -> None:
+        self.entries.put(dir_id, (version, listing))
+
+    async def invalidate(self, *dir_ids: int) -> None:
+        """Drop the listings of `dir_ids`, or every listing if none are given."""
+        self._drop(dir_ids)
+        if self.async_redis is None:
+            return
+        try:
+            with REDIS_TIME.labels('publish').time():
+                await self.async_redis.publish(self.channel, json.dumps({'origin': self.origin, 'ids': list(dir_ids)}))
+        except RedisError as e:
+            # other workers still catch up through the version check
+            print(f'listing invalidation was not broadcast: {e}')
+
+    def _drop(self, dir_ids) -> None:
+        if not dir_ids:
+            self.entries.clear()
+            return
+        for dir_id in dir_ids:
+            self.entries.pop(dir_id)
+
+    def _on_message(self, message) -> None:
+        try:
+            payload = json.loads(message['data'])
+        except (TypeError, ValueError):
+            return
+        if payload.get('origin') == self.origin:
+            return
+        self._drop(payload.get('ids') or ())
+
+    def start_listener(self) -> None:
+        if self.redis is None or self._listener is not None:
+            return
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_message})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop_listener(self) -> None:
+        if self._listener is None:
+            return
+        self._listener.stop()
+        self._listener = None
+
+
+class BlobCache:
+    """
+    Contents of small files read again and again, kept per worker within `max_bytes`.
+    Entries are checked against the inode, size and mtime of the file they were read from,
+    so a file replaced on disk, by this worker or another, is read anew.
+    A file is admitted once read `admit_after` times lately and no larger than `max_file_size`,
+    and only by evicting entries read less often than itself, so a sweep over many files
+    does not push out the hot ones. Files of `mmap_min_size` and up are mapped instead of copied,
+    their pages stay in the page cache every worker shares. Before Python 3.13 a mapping holds
+    a file descriptor, `max_mapped` bounds how many are open at once.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int,
+            max_file_size: int = 256 * 1024,
+            admit_after: int = 2,
+            mmap_min_size: int = 64 * 1024,
+            max_mapped: int = 256,
+    ):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.admit_after = admit_after
+        self.mmap_min_size = mmap_min_size
+        self.max_mapped = max_mapped
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (key, encoding) -> (validator, contents)
+        self._entries: OrderedDict = OrderedDict()
+        self._encodings: Dict[str, Set[Optional[str]]] = {}
+        self._mapped = 0
+        # reads per file, halved whenever too many files are counted so old reads fade out
+        self._reads: Dict[Hashable, int] = {}
+        self._max_counted = max(1024, 8 * max_bytes // max(self.max_file_size, 1))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def validator(stat: os.stat_result) -> Tuple[int, int, int]:
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, key: str, encoding: Optional[str], stat: os.stat_result) -> Optional[Union[bytes, mmap.mmap]]:
+        """Contents of the file, if cached from the same version of it, and count the read."""
+        if not self.max_bytes or stat.st_size > self.max_file_size:
+            return None
+        entry_key = (key, encoding)
+        with self._lock:
+            self._count(entry_key)
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                if entry[0] == self.validator(stat):
+                    self._entries.move_to_end(entry_key)
+                    self.hits += 1
+                    return entry[1]
+                self._drop(entry_key)
+            self.misses += 1
+            return None
+
+    def admits(self, key: str, encoding: Optional[str], stat: os.stat_result) -> bool:
+        """Whether the file should be kept once read, after `get` missed."""
+        if not self.max_bytes or stat.st_size > self.max_file_size:
+            return False
+        with self._lock:
+            return self._reads.get((key, encoding), 0) >= self.admit_after
+
+    def put(
+            self,
+            key: str,
+            encoding: Optional[str],
+            stat: os.stat_result,
+            contents: Union[bytes, mmap.mmap],
+    ) -> bool:
+        """Keep `contents` of the file `stat` was taken of, if it fits without evicting hotter files."""
+        size = len(contents)
+        if size > self.max_file_size or size != stat.st_size:
+            return False
+        entry_key = (key, encoding)
+        with self._lock:
+            reads = self._reads.get(entry_key, 0)
+            self._drop(entry_key)
+            victims, freed = [], 0
+            for victim_key in self._entries:
+                if self.used_bytes - freed + size <= self.max_bytes:
+                    break
+                if self._reads.get(victim_key, 0) > reads:
+                    return False
+                victims.append(victim_key)
+                freed += len(self._entries[victim_key][1])
+            if self.used_bytes - freed + size > self.max_bytes:
+                return False
+            for victim_key in victims:
+                self._drop(victim_key)
+                self.evictions += 1
+            self._entries[entry_key] = (self.validator(stat), contents)
+            if isinstance(contents, mmap.mmap):
+                self._mapped += 1
+            self._encodings.setdefault(key, set()).add(encoding)
+            self.used_bytes += size
+            return True
+
+    def map(self, path: os.PathLike, stat: os.stat_result) -> Optional[mmap.mmap]:
+        """A read only mapping of the file, if it still is the one of `stat`."""
+        if stat.st_size < max(self.mmap_min_size, 1) or self._mapped >= self.max_mapped:
+            return None
+        with open(path, 'rb') as f:
+            if self.validator(os.fstat(f.fileno())) != self.validator(stat):
+                return None
+            if sys.version_info >= (3, 13):
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ, trackfd=False)
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def invalidate(self, *keys: str) -> None:
+        """Drop the cached contents of `keys` in every encoding, as their files are deleted."""
+        with self._lock:
+            for key in keys:
+                for encoding in list(self._encodings.get(key, ())):
+                    self._drop((key, encoding))
+
+    def _drop(self, entry_key) -> None:
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        self.used_bytes -= len(entry[1])
+        if isinstance(entry[1], mmap.mmap):
+            self._mapped -= 1
+        encodings = self._encodings.get(entry_key[0])
+        if encodings is not None:
+            encodings.discard(entry_key[1])
+            if not encodings:
+                del self._encodings[entry_key[0]]
+        # not closed, a request may be reading the mapping right now, it is unmapped once unreferenced
+
+    def _count(self, entry_key) -> None:
+        self._reads[entry_key] = self._reads.get(entry_key, 0) + 1
+        if len(self._reads) > self._max_counted:
+            self._reads = {key: reads // 2 for key, reads in self._reads.items() if reads > 1}
+
+    def __len__(self):
+        return len(self._entries)
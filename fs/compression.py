@@ -0,0 +1,88 @@
+"""
+Content-Encoding of text-like files, negotiated from Accept-Encoding.
+gzip is always offered, brotli and zstd when their packages are installed
+(the `compression` extra).
+"""
+import zlib
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/x-subrip',
+    'application/xml',
+    'application/yaml',
+    'image/svg+xml',
+}
+
+
+def is_compressible(media_type: str) -> bool:
+    """Text formats gain from compression, media and archives are compressed already."""
+    return (
+        media_type.startswith('text/')
+        or media_type in COMPRESSIBLE_TYPES
+        or media_type.endswith(('+json', '+xml'))
+    )
+
+
+class BrotliCompressor:
+    """brotli.Compressor with the compress / flush interface of zlib."""
+
+    def __init__(self, quality: int):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+
+# by preference, when the client accepts several equally;
+# levels are moderate as the first download is compressed on the fly
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+if brotli is not None:
+    COMPRESSORS['br'] = lambda: BrotliCompressor(quality=5)
+COMPRESSORS['gzip'] = lambda: zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    The supported encoding the client prefers by `Accept-Encoding` q-values,
+    or None for the identity encoding.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        weight = 1.
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                continue
+        weights[coding.strip().lower()] = weight
+    if 'x-gzip' in weights:
+        weights.setdefault('gzip', weights['x-gzip'])
+
+    best, best_weight = None, 0.
+    for encoding in COMPRESSORS:
+        weight = weights.get(encoding, weights.get('*', 0.))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
@@ -1,9 +1,10 @@
 import enum
 import uuid
-from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import List, Type, Literal, Optional
 
-from sqlalchemy import Integer, Text, Enum, ForeignKey, create_engine
+import msgspec
+from sqlalchemy import BigInteger, DateTime, Index, Integer, Text, Enum, ForeignKey, TypeDecorator, create_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
 
 
@@ -11,11 +12,38 @@ class Base(DeclarativeBase):
     pass
 
 
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class UTCDateTime(TypeDecorator):
+    """
+    Timezone aware datetime, also on backends that store it naive (sqlite).
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
 class FSObjectType(enum.Enum):
     DIR = 'dir'
     FILE = 'file'
 
 
+class Blob(Base):
+    """
+    Content addressed physical file, shared by every FSObject with the same contents.
+    """
+    __tablename__ = 'fs_blob'
+    hash: Mapped[str] = mapped_column(Text(), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger())
+    ref_count: Mapped[int] = mapped_column(Integer(), default=0)
+
+
 class FSObject(Base):
     __tablename__ = 'fs_object'
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
@@ -23,7 +51,16 @@ class FSObject(Base):
     full_path: Mapped[str] = mapped_column(Text(), unique=True)
     ref_id: Mapped[str] = mapped_column(Text(), unique=True)
     type: Mapped[FSObjectType] = mapped_column(Enum(FSObjectType), default=FSObjectType.DIR)
-    parent_id: Mapped[int | None] = mapped_column(Integer(), ForeignKey('fs_object.id'))
+    blob_hash: Mapped[str | None] = mapped_column(Text(), ForeignKey('fs_blob.hash'), index=True)
+    # file metadata, recorded at upload so listings never touch the disk
+    size: Mapped[int | None] = mapped_column(BigInteger())
+    mime_type: Mapped[str | None] = mapped_column(Text())
+    content_hash: Mapped[str | None] = mapped_column(Text())
+    created_at: Mapped[datetime | None] = mapped_column(UTCDateTime(), default=utc_now)
+    modified_at: Mapped[datetime | None] = mapped_column(UTCDateTime(), default=utc_now)
+    # bumped whenever the listing of a directory changes
+    version: Mapped[int | None] = mapped_column(Integer(), default=0)
+    parent_id: Mapped[int | None] = mapped_column(Integer(), ForeignKey('fs_object.id'), index=True)
     parent: Mapped[Type['FSObject'] | None] = relationship(
         'FSObject',
         remote_side=[id],
@@ -35,9 +72,21 @@ class FSObject(Base):
         cascade='all, delete-orphan',
     )
 
+    __table_args__ = (
+        # subtrees are scanned as byte-ordered ranges of full_path,
+        # the unique index serves them on sqlite, postgres needs the C collation
+        Index('ix_fs_object_full_path_c', full_path.collate('C')).ddl_if(dialect='postgresql'),
+        # listings are paged by (name, id) within a directory
+        Index('ix_fs_object_parent_id_name', parent_id, name, id),
+    )
+
+    @property
+    def storage_key(self) -> str:
+        """Name of the physical file, shared blob if deduplicated."""
+        return self.blob_hash or self.ref_id
 
-@dataclass
-class FSObjectDto:
+
+class FSObjectDto(msgspec.Struct):
     name: str
     id: Optional[int] = None
     full_path: Optional[str] = None
@@ -46,8 +95,24 @@ class FSObjectDto:
     parent_id: Optional[int] = None
     type: Optional[str] = None
 
+    # the columns from_row needs, selected without loading FSObject instances
+    columns = (
+        FSObject.id,
+        FSObject.name,
+        FSObject.full_path,
+        FSObject.ref_id,
+        FSObject.parent_id,
+        FSObject.type,
+        FSObject.size,
+        FSObject.mime_type,
+        FSObject.content_hash,
+        FSObject.created_at,
+        FSObject.modified_at,
+    )
+
     @classmethod
     def from_entity(cls, entity: FSObject):
+        """Works on FSObject instances and on rows of `FSObjectDto.columns` alike."""
         match entity.type:
             case FSObjectType.DIR:
                 dto = DirDto(
@@ -66,18 +131,26 @@ class FSObjectDto:
                     href='/fs' + entity.full_path,
                     ref_id=entity.ref_id,
                     parent_id=entity.parent_id,
+                    size=entity.size,
+                    mime_type=entity.mime_type,
+                    content_hash=entity.content_hash,
+                    created_at=entity.created_at,
+                    modified_at=entity.modified_at,
                 )
             case _:
                 raise ValueError('wrong type')
         return dto
 
 
-@dataclass
 class FileDto(FSObjectDto):
     type: Literal['file'] = 'file'
+    size: Optional[int] = None
+    mime_type: Optional[str] = None
+    content_hash: Optional[str] = None
+    created_at: Optional[datetime] = None
+    modified_at: Optional[datetime] = None
 
 
-@dataclass
 class DirDto(FSObjectDto):
     type: Literal['dir'] = 'dir'
 
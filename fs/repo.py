@@ -1,10 +1,19 @@
+import threading
 from abc import ABC
-from typing import List, Optional, Iterable
+from typing import Callable, List, Optional, Iterable, Tuple
 
-from sqlalchemy import create_engine, inspect, select, exists
+from sqlalchemy import create_engine, inspect, select, exists, update, delete, func, and_, or_, literal, make_url, tuple_
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import sessionmaker
 
-from .models import FSObject, FSObjectType
+from .models import Blob, FSObject, FSObjectDto, FSObjectType, utc_now
+from .search import escape_like, glob_to_regex, search_table
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
 
 
 class RepositorySession(ABC):
@@ -31,26 +40,174 @@ class RepositorySession(ABC):
 class RepositoryFactory:
     """
     Factory class to create repository sessions.
+    The engine is made when first needed, `on_engine` is called with it then.
     """
 
-    def __init__(self, connection_string: str = 'sqlite:///test.sqlite'):
-        self.engine = create_engine(connection_string)
-        self.session_maker = sessionmaker(
-            autoflush=True,
-            bind=self.engine,
-        )
+    def __init__(self, connection_string: str = 'sqlite:///test.sqlite', on_engine: Optional[Callable] = None):
+        self.connection_string = connection_string
+        self.on_engine = on_engine
+        self.session_maker = None
+        self._engine = None
+        self._lock = threading.Lock()
+
+        # connects to the database, made when first needed
+        self._inspector = None
 
-        self._inspector = inspect(self.engine)
+    @property
+    def engine(self):
+        # background jobs may be first to ask, from their own threads
+        with self._lock:
+            if self._engine is None:
+                engine = create_engine(self.connection_string)
+                if self.on_engine is not None:
+                    self.on_engine(engine)
+                self.session_maker = sessionmaker(
+                    autoflush=True,
+                    bind=engine,
+                )
+                self._engine = engine
+        return self._engine
 
     @property
     def inspector(self):
+        if self._inspector is None:
+            self._inspector = inspect(self.engine)
         return self._inspector
 
     def __call__(self, target: type[RepositorySession], *args, **kwargs) -> RepositorySession:
+        self.engine
+        return target(self.session_maker(), *args, **kwargs)
+
+
+class AsyncRepositorySession(ABC):
+    """
+    Abstract Repository Session over an asyncio database session,
+    to be used with `async with`.
+    """
+
+    def __init__(self, session, *args, **kwargs):
+        self.session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            await self.session.rollback()
+        else:
+            await self.session.commit()
+        await self.session.close()
+        self.session = None
+
+
+class AsyncRepositoryFactory:
+    """
+    Factory class to create asyncio repository sessions.
+    Synchronous connection strings are switched to the matching asyncio driver.
+    The engine is made when first needed, `on_engine` is called with its sync_engine then.
+    """
+
+    def __init__(
+            self,
+            connection_string: str = 'sqlite:///test.sqlite',
+            pool_size: int = 10,
+            max_overflow: int = 20,
+            pool_pre_ping: bool = True,
+            statement_cache_size: int = 500,
+            on_engine: Optional[Callable] = None,
+    ):
+        url = make_url(connection_string)
+        if url.drivername in ASYNC_DRIVERS:
+            url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+
+        engine_args = dict(pool_pre_ping=pool_pre_ping, query_cache_size=statement_cache_size)
+        if url.database not in (None, '', ':memory:'):
+            engine_args.update(pool_size=pool_size, max_overflow=max_overflow)
+        if url.drivername == 'postgresql+asyncpg':
+            engine_args['connect_args'] = {'prepared_statement_cache_size': statement_cache_size}
+        self.url = url
+        self.engine_args = engine_args
+        self.on_engine = on_engine
+        self.session_maker = None
+        self._engine = None
+
+    @property
+    def engine(self):
+        # only used from the event loop, no lock needed
+        if self._engine is None:
+            engine = create_async_engine(self.url, **self.engine_args)
+            if self.on_engine is not None:
+                self.on_engine(engine.sync_engine)
+            self.session_maker = async_sessionmaker(
+                autoflush=True,
+                bind=engine,
+                expire_on_commit=False,
+            )
+            self._engine = engine
+        return self._engine
+
+    def __call__(self, target: type[AsyncRepositorySession], *args, **kwargs) -> AsyncRepositorySession:
+        self.engine
         return target(self.session_maker(), *args, **kwargs)
 
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+
+
+class FSStatements:
+    """
+    Statements shared by the synchronous and asyncio repositories.
+    """
+
+    def in_subtree(self, full_path: str):
+        """
+        Condition matching every descendant of `full_path`.
+        Descendants are exactly the paths between `{full_path}/` and `{full_path}0`,
+        as '0' sorts right after '/', so this is a range scan of the full_path index
+        and names holding LIKE wildcards need no escaping.
+        """
+        prefix = full_path.rstrip('/') + '/'
+        column = self.byte_ordered_path()
+        return and_(column > prefix, column < prefix[:-1] + '0')
 
-class FSRepository(RepositorySession):
+    def byte_ordered_path(self):
+        """full_path compared byte by byte, as the subtree ranges need, with the index serving it."""
+        if self.session.bind.dialect.name == 'postgresql':
+            return FSObject.full_path.collate('C')
+        return FSObject.full_path
+
+    def _move_descendants(self, full_path: str, new_path: str):
+        return update(FSObject).where(self.in_subtree(full_path)).values(
+            full_path=literal(new_path) + func.substr(FSObject.full_path, len(full_path) + 1),
+        ).execution_options(synchronize_session=False)
+
+    @staticmethod
+    def _touch(ids: Iterable[int]):
+        return update(FSObject).where(FSObject.id.in_(ids)).values(
+            version=func.coalesce(FSObject.version, 0) + 1,
+            modified_at=utc_now(),
+        ).execution_options(synchronize_session=False)
+
+    def _touch_descendant_dirs(self, full_path: str):
+        return update(FSObject).where(
+            self.in_subtree(full_path),
+            FSObject.type == FSObjectType.DIR,
+        ).values(
+            version=func.coalesce(FSObject.version, 0) + 1,
+            modified_at=utc_now(),
+        ).execution_options(synchronize_session=False)
+
+    @staticmethod
+    def _add_blob_ref(content_hash: str):
+        return update(Blob).where(Blob.hash == content_hash).values(ref_count=Blob.ref_count + 1)
+
+    @staticmethod
+    def _drop_blob_refs(content_hash: str, count: int):
+        return update(Blob).where(Blob.hash == content_hash).values(ref_count=Blob.ref_count - count)
+
+
+class FSRepository(FSStatements, RepositorySession):
     def create_root(self) -> FSObject:
         root = FSObject(
             name='/',
@@ -87,14 +244,273 @@ class FSRepository(RepositorySession):
         return self.session.scalar(exists().where(FSObject.full_path == full_path).select())
 
     def read_all_descendants(self, full_path: str = '') -> Iterable[FSObject]:
-        return self.session.scalars(select(FSObject).where(FSObject.full_path.like(f'{full_path}/%')))
+        return self.session.scalars(select(FSObject).where(self.in_subtree(full_path)))
 
     def read_all_descendant_files(self, full_path: str = '') -> Iterable[FSObject]:
         return self.session.scalars(
             select(FSObject).where(
-                FSObject.full_path.like(f'{full_path}/%'),
+                self.in_subtree(full_path),
                 FSObject.type == FSObjectType.FILE)
         )
 
+    def move_descendants(self, full_path: str, new_path: str) -> None:
+        """Rewrite the paths of every descendant of `full_path` to live under `new_path`, in one statement."""
+        self.session.execute(self._move_descendants(full_path, new_path))
+
+    def touch(self, *ids: int) -> None:
+        """Mark the listings of directories `ids` as changed."""
+        self.session.execute(self._touch(ids))
+
+    def touch_descendant_dirs(self, full_path: str) -> None:
+        self.session.execute(self._touch_descendant_dirs(full_path))
+
     def listdir(self, dir_obj: FSObject) -> List[FSObject]:
         return self.session.scalars(select(FSObject).where(FSObject.parent_id == dir_obj.id))
+
+    def acquire_blob(self, content_hash: str, size: int) -> bool:
+        """
+        Add a reference to the blob of `content_hash`.
+        Returns True if the blob is new and its contents must be stored.
+        """
+        updated = self.session.execute(self._add_blob_ref(content_hash)).rowcount
+        if updated:
+            return False
+        self.session.add(Blob(hash=content_hash, size=size, ref_count=1))
+        self.session.flush()
+        return True
+
+    def release_blob(self, content_hash: str, count: int = 1) -> bool:
+        """
+        Drop `count` references to the blob of `content_hash`.
+        Returns True if it is no longer referenced and its contents may be removed.
+        """
+        self.session.execute(self._drop_blob_refs(content_hash, count))
+        remaining = self.session.scalar(select(Blob.ref_count).where(Blob.hash == content_hash))
+        if remaining is None:
+            return True
+        if remaining > 0:
+            return False
+        self.session.execute(delete(Blob).where(Blob.hash == content_hash))
+        return True
+
+    def stream_file_keys(self, after_id: int = 0, limit: int = 1000):
+        """
+        (id, full_path, ref_id, blob_hash) of the next `limit` files past `after_id` in id order,
+        streamed from a server side cursor without building ORM objects.
+        """
+        return self.session.execute(
+            select(FSObject.id, FSObject.full_path, FSObject.ref_id, FSObject.blob_hash).where(
+                FSObject.type == FSObjectType.FILE,
+                FSObject.id > after_id,
+            ).order_by(FSObject.id).limit(limit).execution_options(yield_per=limit)
+        )
+
+    def referenced_keys(self, keys: Iterable[str]) -> set:
+        """Which of the physical file names `keys` are referenced by a file or a blob."""
+        keys = list(keys)
+        refs = self.session.scalars(select(FSObject.ref_id).where(
+            FSObject.ref_id.in_(keys),
+            FSObject.type == FSObjectType.FILE,
+            FSObject.blob_hash.is_(None),
+        ))
+        blobs = self.session.scalars(select(Blob.hash).where(Blob.hash.in_(keys)))
+        return set(refs) | set(blobs)
+
+    def existing_ref_ids(self, ref_ids: Iterable[str]) -> set:
+        return set(self.session.scalars(select(FSObject.ref_id).where(FSObject.ref_id.in_(list(ref_ids)))))
+
+    def read_files_without_blob(self, after_id: int = 0, limit: int = 500) -> Iterable[FSObject]:
+        return self.session.scalars(
+            select(FSObject).where(
+                FSObject.type == FSObjectType.FILE,
+                FSObject.blob_hash.is_(None),
+                FSObject.id > after_id,
+            ).order_by(FSObject.id).limit(limit)
+        )
+
+    def read_files_without_metadata(self, after_id: int = 0, limit: int = 500) -> Iterable[FSObject]:
+        return self.session.scalars(
+            select(FSObject).where(
+                FSObject.type == FSObjectType.FILE,
+                FSObject.size.is_(None),
+                FSObject.id > after_id,
+            ).order_by(FSObject.id).limit(limit)
+        )
+
+
+class AsyncFSRepository(FSStatements, AsyncRepositorySession):
+    """
+    Asyncio counterpart of FSRepository used while serving requests.
+    Relationships are never lazy loaded, children and parents are queried explicitly.
+    """
+
+    async def create(self, fs_object: FSObject) -> FSObject:
+        self.session.add(fs_object)
+        await self.session.flush()
+        return fs_object
+
+    async def get_by_id(self, pk: int) -> Optional[FSObject]:
+        return await self.session.get(FSObject, pk)
+
+    async def get_by_path(self, full_path: str) -> Optional[FSObject]:
+        return await self.session.scalar(select(FSObject).where(FSObject.full_path == full_path))
+
+    async def get_by_ref(self, ref_id: str) -> Optional[FSObject]:
+        return await self.session.scalar(select(FSObject).where(FSObject.ref_id == ref_id))
+
+    async def exists_by_path(self, full_path: str) -> bool:
+        return await self.session.scalar(exists().where(FSObject.full_path == full_path).select())
+
+    async def listdir(
+            self,
+            dir_id: int,
+            parent_id: Optional[int] = None,
+            order_by: Optional[str] = None,
+            after: Optional[Tuple[str, int]] = None,
+            limit: Optional[int] = None,
+    ) -> Tuple[Optional[Row], List[Row]]:
+        """
+        Rows of `FSObjectDto.columns` for the children of directory `dir_id`, and for its parent
+        `parent_id` if given. Only the columns are read, no FSObject instances are built.
+        Children come in no particular order unless `order_by` is 'name' or 'id'.
+        For keyset pagination, `after` is the (name, id) of the last entry of the previous page.
+        """
+        query = select(*FSObjectDto.columns)
+        if parent_id is not None and order_by is None and limit is None:
+            # the whole directory is read anyway, the parent comes along in the same statement
+            rows = list(await self.session.execute(query.where(
+                or_(FSObject.parent_id == dir_id, FSObject.id == parent_id)
+            )))
+            parent = next((row for row in rows if row.id == parent_id), None)
+            return parent, [row for row in rows if row.id != parent_id]
+
+        parent = None
+        if parent_id is not None:
+            parent = (await self.session.execute(query.where(FSObject.id == parent_id))).first()
+
+        query = query.where(FSObject.parent_id == dir_id)
+        if order_by == 'name':
+            query = query.order_by(FSObject.name, FSObject.id)
+            if after is not None:
+                query = query.where(tuple_(FSObject.name, FSObject.id) > tuple_(*after))
+        elif order_by == 'id':
+            query = query.order_by(FSObject.id)
+            if after is not None:
+                query = query.where(FSObject.id > after[1])
+        if limit is not None:
+            query = query.limit(limit)
+        return parent, list(await self.session.execute(query))
+
+    async def read_descendant_file_keys(self, full_path: str) -> List[Tuple[str, Optional[str]]]:
+        """(ref_id, blob_hash) of every file below `full_path`."""
+        rows = await self.session.execute(
+            select(FSObject.ref_id, FSObject.blob_hash).where(
+                self.in_subtree(full_path),
+                FSObject.type == FSObjectType.FILE,
+            )
+        )
+        return [tuple(row) for row in rows]
+
+    async def read_descendants(self, full_path: str, after: Optional[str] = None, limit: int = 1000) -> List[Row]:
+        """
+        (full_path, type, ref_id, blob_hash, modified_at) of the next `limit` objects below `full_path`
+        in full_path order, starting after the `after` path for keyset pagination.
+        """
+        column = self.byte_ordered_path()
+        query = select(
+            FSObject.full_path, FSObject.type, FSObject.ref_id, FSObject.blob_hash, FSObject.modified_at,
+        ).where(self.in_subtree(full_path)).order_by(column).limit(limit)
+        if after is not None:
+            query = query.where(column > after)
+        return list(await self.session.execute(query))
+
+    async def search(
+            self,
+            term: str,
+            mode: str = 'substring',
+            scope: Optional[str] = None,
+            fs_type: Optional[FSObjectType] = None,
+            after_id: int = 0,
+            limit: int = 1000,
+    ) -> List[Row]:
+        """
+        Rows of `FSObjectDto.columns` whose name contains `term`, starts with it or matches it as a glob,
+        in id order after `after_id`, below `scope` and of type `fs_type` if given.
+        Substring and prefix searches ignore case, globs do not.
+        """
+        # directory names are stored with their leading slash, which prefixes and globs look past
+        query = select(*FSObjectDto.columns)
+        if self.session.bind.dialect.name == 'postgresql':
+            key = FSObject.id
+            if mode == 'glob':
+                query = query.where(FSObject.name.op('~')('^/?' + glob_to_regex(term)[1:]))
+            elif mode == 'prefix':
+                pattern = escape_like(term) + '%'
+                query = query.where(or_(
+                    FSObject.name.ilike(pattern, escape='\\'),
+                    FSObject.name.ilike('/' + pattern, escape='\\'),
+                ))
+            else:
+                query = query.where(FSObject.name.ilike(f'%{escape_like(term)}%', escape='\\'))
+        else:
+            # the trigram table answers LIKE and GLOB, but not LIKE with an ESCAPE clause nor an OR,
+            # it finds the candidates and the exact condition is checked on those
+            key = search_table.c.rowid
+            query = query.select_from(search_table.join(FSObject, FSObject.id == search_table.c.rowid))
+            if mode == 'glob':
+                query = query.where(
+                    search_table.c.name.op('GLOB')(term if term.startswith('*') else '*' + term),
+                    or_(FSObject.name.op('GLOB')(term), FSObject.name.op('GLOB')('/' + term)),
+                )
+            else:
+                query = query.where(search_table.c.name.like(f'%{term}%'))
+                pattern = escape_like(term) + '%'
+                if mode == 'prefix':
+                    query = query.where(or_(
+                        FSObject.name.like(pattern, escape='\\'),
+                        FSObject.name.like('/' + pattern, escape='\\'),
+                    ))
+                elif '%' in term or '_' in term:
+                    # wildcards in the term widened the match
+                    query = query.where(FSObject.name.like('%' + pattern, escape='\\'))
+
+        if scope is not None:
+            query = query.where(self.in_subtree(scope))
+        if fs_type is not None:
+            query = query.where(FSObject.type == fs_type)
+        query = query.where(key > after_id).order_by(key).limit(limit)
+        return list(await self.session.execute(query))
+
+    async def delete_tree(self, target: FSObject) -> None:
+        """Delete `target` and all of its descendants in one statement."""
+        condition = FSObject.id == target.id
+        if target.type == FSObjectType.DIR:
+            condition = or_(condition, self.in_subtree(target.full_path))
+        await self.session.execute(delete(FSObject).where(condition).execution_options(synchronize_session=False))
+
+    async def move_descendants(self, full_path: str, new_path: str) -> None:
+        await self.session.execute(self._move_descendants(full_path, new_path))
+
+    async def touch(self, *ids: int) -> None:
+        await self.session.execute(self._touch(ids))
+
+    async def touch_descendant_dirs(self, full_path: str) -> None:
+        await self.session.execute(self._touch_descendant_dirs(full_path))
+
+    async def acquire_blob(self, content_hash: str, size: int) -> bool:
+        updated = (await self.session.execute(self._add_blob_ref(content_hash))).rowcount
+        if updated:
+            return False
+        self.session.add(Blob(hash=content_hash, size=size, ref_count=1))
+        await self.session.flush()
+        return True
+
+    async def release_blob(self, content_hash: str, count: int = 1) -> bool:
+        await self.session.execute(self._drop_blob_refs(content_hash, count))
+        remaining = await self.session.scalar(select(Blob.ref_count).where(Blob.hash == content_hash))
+        if remaining is None:
+            return True
+        if remaining > 0:
+            return False
+        await self.session.execute(delete(Blob).where(Blob.hash == content_hash))
+        return True
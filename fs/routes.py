@@ -1,38 +1,76 @@
-from pathlib import Path
-from typing import List, Iterable, Optional, Annotated, AsyncGenerator
+from typing import Optional, Annotated, Literal
 
 from litestar import get, post, Request, delete, patch, Response
 from litestar.params import QueryParameter
 from litestar.response import Stream
 
 from singletons import service
-from utils import get_mime_type
 from .models import FSObjectDto
 
+# directory listings are paged with ?limit=&cursor=&order=name|id, or streamed with ?format=ndjson,
+# ?archive=zip|tar downloads the directory as an archive, not compressed with &store
+Limit = Optional[int]
+Cursor = Optional[str]
+Order = Literal['name', 'id']
+OutputFormat = Annotated[Optional[Literal['json', 'ndjson']], QueryParameter(name='format')]
+Archive = Optional[Literal['zip', 'tar']]
+# /search?q= matches names by substring, prefix or glob, scoped with &scope=/dir and &type=file|dir
+SearchMode = Literal['substring', 'prefix', 'glob']
+SearchScope = Annotated[Optional[str], QueryParameter(name='scope')]
+SearchType = Annotated[Optional[Literal['file', 'dir']], QueryParameter(name='type')]
+
 
 @get('/')
-async def index() -> Iterable[FSObjectDto]:
-    return service.list_root()
+async def index(
+        request: Request,
+        limit: Limit = None,
+        cursor: Cursor = None,
+        order: Order = 'name',
+        output_format: OutputFormat = None,
+        archive: Archive = None,
+) -> Response | Stream:
+    page = service.listing_page(limit, cursor, order, output_format == 'ndjson')
+    return await service.list_root(request.headers, page, archive, 'store' in request.query_params)
 
 
 @get('/{full_path:path}')
-async def get_obj(full_path: str) -> Response | Stream:
-    found = await service.get_obj(full_path)
-    if isinstance(found, AsyncGenerator):
-        return Stream(
-            found,
-            media_type=get_mime_type(Path(full_path).name),
-        )
-    else:
-        return Response(
-            found,
-            media_type='application/json',
-        )
+async def get_obj(
+        request: Request,
+        full_path: str,
+        limit: Limit = None,
+        cursor: Cursor = None,
+        order: Order = 'name',
+        output_format: OutputFormat = None,
+        archive: Archive = None,
+) -> Response | Stream:
+    page = service.listing_page(limit, cursor, order, output_format == 'ndjson')
+    return await service.get_obj(full_path, request.headers, page, archive, 'store' in request.query_params)
 
 
 @get('/ref', status_code=200)
-async def get_obj_by_ref(ref_id: Annotated[str, QueryParameter(name='query')]) -> List[FSObjectDto] | Stream:
-    return await service.get_obj_by_ref(ref_id)
+async def get_obj_by_ref(
+        request: Request,
+        ref_id: Annotated[str, QueryParameter(name='query')],
+        limit: Limit = None,
+        cursor: Cursor = None,
+        order: Order = 'name',
+        output_format: OutputFormat = None,
+        archive: Archive = None,
+) -> Response | Stream:
+    page = service.listing_page(limit, cursor, order, output_format == 'ndjson')
+    return await service.get_obj_by_ref(ref_id, request.headers, page, archive, 'store' in request.query_params)
+
+
+@get('/search')
+async def search(
+        q: str,
+        mode: SearchMode = 'substring',
+        scope_path: SearchScope = None,
+        fs_type: SearchType = None,
+        limit: Limit = None,
+        cursor: Cursor = None,
+) -> Response:
+    return await service.search(q, mode, scope_path, fs_type, service.listing_page(limit, cursor, 'id'))
 
 
 @post(['/', '/{full_path:path}'], status_code=201)
@@ -41,10 +79,10 @@ async def create_obj(
         full_path: str = '/',
 ) -> FSObjectDto:
     if 'isdir' in request.query_params:
-        return service.create_dir(full_path)
+        return await service.create_dir(full_path)
 
     data = (await request.form()).get('data')
-    return service.create_file(full_path, data)
+    return await service.create_file(full_path, data)
 
 
 @patch('/{full_path:path}')
@@ -54,7 +92,9 @@ async def rename(
 ) -> FSObjectDto:
     if full_path.endswith('/'):
         full_path = full_path[:-1]
-    return service.rename(full_path, data.name)
+    if data.full_path:
+        return await service.move(full_path, data.full_path)
+    return await service.rename(full_path, data.name)
 
 
 @delete('/{full_path:path}', status_code=204)
@@ -71,6 +111,7 @@ handlers = [
     index,
     get_obj,
     get_obj_by_ref,
+    search,
     create_obj,
     rename,
     delete_target
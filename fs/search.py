@@ -0,0 +1,85 @@
+"""
+Name search backed by a trigram index: an FTS5 table kept up to date by triggers
+on sqlite, a pg_trgm GIN index on postgres.
+Both answer substring, prefix and glob patterns from the index once the pattern
+holds three characters in a row, shorter patterns scan.
+"""
+import re
+
+from sqlalchemy import Column, Integer, MetaData, Text, Table, text
+
+# the FTS5 table, apart from Base.metadata as create_all can not create it
+search_table = Table(
+    'fs_object_name_fts',
+    MetaData(),
+    Column('rowid', Integer, primary_key=True),
+    Column('name', Text),
+)
+
+SQLITE_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS fs_object_name_fts_insert AFTER INSERT ON fs_object BEGIN "
+    "INSERT INTO fs_object_name_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS fs_object_name_fts_delete AFTER DELETE ON fs_object BEGIN "
+    "INSERT INTO fs_object_name_fts(fs_object_name_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS fs_object_name_fts_update AFTER UPDATE OF name ON fs_object BEGIN "
+    "INSERT INTO fs_object_name_fts(fs_object_name_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO fs_object_name_fts(rowid, name) VALUES (new.id, new.name); END",
+)
+
+POSTGRES_DDL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_fs_object_name_trgm ON fs_object USING gin (name gin_trgm_ops)',
+)
+
+
+def ensure_search_index(conn) -> None:
+    """Create the name index if it is missing, indexing the names already stored."""
+    if conn.dialect.name == 'postgresql':
+        for statement in POSTGRES_DDL:
+            conn.execute(text(statement))
+        return
+
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fs_object_name_fts'"
+    )).first()
+    if not exists:
+        print('creating the name search index')
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE fs_object_name_fts USING fts5("
+            "name, content='fs_object', content_rowid='id', tokenize='trigram')"
+        ))
+        conn.execute(text("INSERT INTO fs_object_name_fts(fs_object_name_fts) VALUES ('rebuild')"))
+    for statement in SQLITE_DDL:
+        conn.execute(text(statement))
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate a shell glob (*, ?, [...]) to an anchored POSIX regular expression."""
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            out.append('.*')
+        elif char == '?':
+            out.append('.')
+        elif char == '[':
+            # a ']' first in the class is one of its characters
+            start = i + 2 if pattern[i + 1:i + 2] == '!' else i + 1
+            end = pattern.find(']', start + 1)
+            if end < 0:
+                out.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return '^' + ''.join(out) + '$'
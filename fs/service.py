@@ -1,74 +1,537 @@
+import base64
+import json
+import os
 import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, AsyncGenerator
+from typing import AsyncIterator, Iterable, Mapping, Optional, Tuple
+from urllib.parse import quote
 
+import msgspec
+from litestar import Response
 from litestar.exceptions import HTTPException
 from litestar.response import Stream
 
-from utils import file_streamer, get_mime_type
-from .models import FSObjectDto, FSObject, FSObjectType, DirDto, FileDto
-from .repo import FSRepository, RepositoryFactory
+from utils import (
+    RangeNotSatisfiable,
+    file_streamer,
+    get_mime_type,
+    http_date,
+    is_not_modified,
+    multipart_ranges,
+    parse_http_date,
+    parse_range_header,
+    run_io,
+)
+from .archive import ArchiveEntry, tar_stream, zip_stream
+from .compression import COMPRESSORS, is_compressible, negotiate_encoding
+from .models import FSObjectDto, FSObject, FSObjectType, DirDto, FileDto, utc_now
+from .cache import BlobCache, ListingCache
+from .repo import AsyncFSRepository, AsyncRepositoryFactory
+from .storage import BlobStore, hash_file
+
+ndjson_encoder = msgspec.json.Encoder()
+
+
+@dataclass
+class ListingPage:
+    """
+    One page of a directory listing, ordered by 'name' or 'id',
+    starting after the (name, id) key of the last entry of the previous page.
+    """
+    limit: int
+    order: str = 'name'
+    after: Optional[Tuple[str, int]] = None
+    ndjson: bool = False
+
+    def next_cursor(self, last: FSObject) -> str:
+        key = json.dumps([self.order, last.name, last.id]).encode()
+        return base64.urlsafe_b64encode(key).decode().rstrip('=')
+
+    @staticmethod
+    def parse_cursor(cursor: str, order: str) -> Tuple[str, int]:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            cursor_order, name, pk = key
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail='invalid cursor')
+        if cursor_order != order or not isinstance(name, str) or not isinstance(pk, int):
+            raise HTTPException(status_code=400, detail='invalid cursor')
+        return name, pk
 
 
 class FSService:
-    def __init__(self, repo_factory: RepositoryFactory, root_dir: Path):
+    archive_batch_size = 1000
+
+    def __init__(
+            self,
+            repo_factory: AsyncRepositoryFactory,
+            root_dir: Path,
+            dedupe: bool = False,
+            listing_cache: Optional[ListingCache] = None,
+            listing_page_size: int = 1000,
+            compress: bool = False,
+            compress_min_size: int = 1024,
+            blob_cache: Optional[BlobCache] = None,
+    ):
         self.repo_factory = repo_factory
         self.root_dir = root_dir
+        self.storage = BlobStore(root_dir)
+        self.dedupe = dedupe
+        self.listing_cache = listing_cache or ListingCache(0)
+        self.listing_page_size = listing_page_size
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.blob_cache = blob_cache if blob_cache is not None else BlobCache(0)
 
     def get_session(self):
-        return self.repo_factory(FSRepository)
-
-    def list_dir(self, full_path: str) -> Iterable[FSObjectDto]:
-        with self.get_session() as session:
-            dir_entity = session.get_by_path(full_path)
-            return list(map(FSObjectDto.from_entity, dir_entity.children))
-
-    def list_root(self) -> Iterable[FSObjectDto]:
-        return self.list_dir('/')
-
-    async def get_obj(self, full_path: str) -> Iterable[FSObjectDto] | AsyncGenerator[bytes, None]:
-        with self.get_session() as session:
-            target = session.get_by_path(full_path)
+        return self.repo_factory(AsyncFSRepository)
+
+    async def list_dir(self, full_path: str) -> Iterable[FSObjectDto]:
+        async with self.get_session() as session:
+            dir_entity = await session.get_by_path(full_path)
+            _, children = await session.listdir(dir_entity.id)
+            return list(map(FSObjectDto.from_entity, children))
+
+    async def list_root(
+            self,
+            headers: Optional[Mapping[str, str]] = None,
+            page: Optional[ListingPage] = None,
+            archive: Optional[str] = None,
+            store: bool = False,
+    ) -> Response | Stream:
+        async with self.get_session() as session:
+            root = await session.get_by_path('/')
+            if archive:
+                return self.archive_response(root, archive, store)
+            return await self.listing_response(session, root, headers or {}, page)
+
+    def listing_page(
+            self,
+            limit: Optional[int] = None,
+            cursor: Optional[str] = None,
+            order: str = 'name',
+            ndjson: bool = False,
+    ) -> Optional[ListingPage]:
+        """The requested page, None for the whole listing in one JSON array."""
+        if limit is None and cursor is None and not ndjson:
+            return None
+        if order not in ('name', 'id'):
+            raise HTTPException(status_code=400, detail='order must be name or id')
+        if limit is not None and limit < 1:
+            raise HTTPException(status_code=400, detail='limit must be positive')
+        after = ListingPage.parse_cursor(cursor, order) if cursor else None
+        return ListingPage(min(limit or self.listing_page_size, self.listing_page_size), order, after, ndjson)
+
+    async def listing_response(
+            self,
+            session: AsyncFSRepository,
+            target: FSObject,
+            headers: Mapping[str, str],
+            page: Optional[ListingPage] = None,
+    ) -> Response | Stream:
+        """
+        Respond with the listing of directory `target`, with a `..` entry unless it is the root.
+        Answers 304 from the directory version alone if the client copy is current.
+        With `page`, only that page is sent and the cursor of the next one is in `X-Next-Cursor`,
+        or every entry from the cursor on is streamed as NDJSON; `..` is on the first page only.
+        """
+        version = target.version or 0
+        etag = f'W/"{target.id}-{version}"'
+        last_modified = target.modified_at
+        validators = {'ETag': etag}
+        if last_modified:
+            validators['Last-Modified'] = http_date(last_modified.timestamp())
+        if is_not_modified(headers, etag, last_modified):
+            return Response(None, status_code=304, headers=validators)
+        if page is not None:
+            return await self._listing_page_response(session, target, page, validators)
+
+        listdir = self.listing_cache.get(target.id, version)
+        if listdir is None:
+            parent, children = await session.listdir(target.id, target.parent_id)
+            listdir = list(map(FSObjectDto.from_entity, children))
+            if parent is not None:
+                listdir.append(self._parent_dto(parent))
+            self.listing_cache.put(target.id, version, listdir)
+        return Response(listdir, media_type='application/json', headers=validators)
+
+    async def _listing_page_response(
+            self,
+            session: AsyncFSRepository,
+            target: FSObject,
+            page: ListingPage,
+            headers: dict,
+    ) -> Response | Stream:
+        # `..` is on the first page only
+        parent_id = target.parent_id if page.after is None else None
+        if page.ndjson:
+            return Stream(
+                self._stream_listing(target.id, parent_id, page),
+                media_type='application/x-ndjson',
+                headers=headers,
+            )
+
+        # one extra row tells whether there is a next page
+        parent, children = await session.listdir(target.id, parent_id, page.order, page.after, page.limit + 1)
+        if len(children) > page.limit:
+            children = children[:page.limit]
+            headers['X-Next-Cursor'] = page.next_cursor(children[-1])
+        listdir = [self._parent_dto(parent)] if parent is not None else []
+        listdir.extend(map(FSObjectDto.from_entity, children))
+        return Response(listdir, media_type='application/json', headers=headers)
+
+    async def _stream_listing(self, dir_id: int, parent_id: Optional[int], page: ListingPage) -> AsyncIterator[bytes]:
+        """
+        Every entry of `dir_id` after `page.after` as JSON lines, fetched `page.limit` at a time.
+        A connection is only held while a batch is read, not while the client consumes it.
+        """
+        after = page.after
+        while True:
+            async with self.get_session() as session:
+                parent, children = await session.listdir(dir_id, parent_id, page.order, after, page.limit)
+            listdir = [self._parent_dto(parent)] if parent is not None else []
+            listdir.extend(map(FSObjectDto.from_entity, children))
+            if listdir:
+                yield ndjson_encoder.encode_lines(listdir)
+            if len(children) < page.limit:
+                return
+            parent_id, after = None, (children[-1].name, children[-1].id)
+
+    @staticmethod
+    def _parent_dto(parent) -> FSObjectDto:
+        dto = FSObjectDto.from_entity(parent)
+        dto.name = '..'
+        return dto
+
+    def archive_response(self, target: FSObject, archive: str, store: bool = False) -> Stream:
+        """
+        Stream directory `target` with everything below it as a zip or tar archive.
+        zip entries are deflated unless `store` is set, tar entries are always stored.
+        """
+        name = Path(target.full_path).name or 'root'
+        if archive == 'zip':
+            body, media_type = zip_stream(self._archive_entries(target), store), 'application/zip'
+        elif archive == 'tar':
+            body, media_type = tar_stream(self._archive_entries(target)), 'application/x-tar'
+        else:
+            raise HTTPException(status_code=400, detail='archive must be zip or tar')
+        return Stream(
+            body,
+            media_type=media_type,
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}.{archive}"},
+        )
+
+    async def _archive_entries(self, target: FSObject) -> AsyncIterator[ArchiveEntry]:
+        """
+        `target` and its descendants in full_path order, named relative to the parent of `target`.
+        Read in keyset batches, each in its own short session.
+        """
+        strip = len(target.full_path) - len(Path(target.full_path).name)
+        if target.parent_id is not None:
+            yield ArchiveEntry(target.full_path[strip:], target.modified_at or utc_now())
+        after = None
+        while True:
+            async with self.get_session() as session:
+                rows = await session.read_descendants(target.full_path, after, self.archive_batch_size)
+            for row in rows:
+                path = None if row.type == FSObjectType.DIR else self.storage.path(row.blob_hash or row.ref_id)
+                yield ArchiveEntry(row.full_path[strip:], row.modified_at or utc_now(), path)
+            if len(rows) < self.archive_batch_size:
+                return
+            after = rows[-1].full_path
+
+    def stream_file(self, target: FSObject, headers: Mapping[str, str]) -> Response:
+        """
+        Build the response streaming the physical file of `target`,
+        honoring conditional requests with 304 and `Range` / `If-Range` with 206 and 416 responses.
+        Stored metadata is enough to answer 304, the disk is only touched to send contents.
+        Hot small files are sent from the blob cache, after a stat to tell they are unchanged.
+        """
+        file_path = self.storage.path(target.storage_key)
+        stat = None
+        if target.size is None or target.modified_at is None:
+            stat = self._stat(file_path)
+            size, last_modified = stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        else:
+            size, last_modified = target.size, target.modified_at
+        etag = f'"{target.content_hash}"' if target.content_hash else f'"{size:x}-{int(last_modified.timestamp()):x}"'
+
+        media_type = get_mime_type(target.name)
+        validators = {
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified.timestamp()),
+        }
+        encoding = None
+        if self.compress and is_compressible(media_type) and size >= self.compress_min_size:
+            validators['Vary'] = 'Accept-Encoding'
+            # ranges are served from the identity encoding
+            if not headers.get('Range'):
+                encoding = negotiate_encoding(headers.get('Accept-Encoding'))
+            if encoding:
+                # every encoding is a representation of its own
+                validators['ETag'] = f'{etag[:-1]}-{encoding}"'
+        if is_not_modified(headers, validators['ETag'], last_modified):
+            return Response(None, status_code=304, headers=validators)
+
+        if stat is None:
+            stat = self._stat(file_path)
+            size = stat.st_size
+        if encoding:
+            return self._encoded_response(target, file_path, stat, encoding, media_type, validators)
+        headers_out = {'Accept-Ranges': 'bytes', **validators}
+
+        ranges = None
+        range_header = headers.get('Range')
+        if range_header and self._if_range_matches(headers.get('If-Range'), etag, last_modified):
+            try:
+                ranges = parse_range_header(range_header, size)
+            except RangeNotSatisfiable:
+                raise HTTPException(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+
+        if not ranges:
+            contents = self.blob_cache.get(target.storage_key, None, stat)
+            if contents is not None:
+                return Response(contents[:], media_type=media_type, headers=headers_out)
+            headers_out['Content-Length'] = str(size)
+            return Stream(
+                self._cached_stream(file_streamer(file_path), target.storage_key, None, file_path, stat),
+                media_type=media_type,
+                headers=headers_out,
+            )
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers_out['Content-Range'] = f'bytes {start}-{end}/{size}'
+            contents = self.blob_cache.get(target.storage_key, None, stat)
+            if contents is not None:
+                return Response(contents[start:end + 1], status_code=206, media_type=media_type, headers=headers_out)
+            headers_out['Content-Length'] = str(end - start + 1)
+            if self.blob_cache.admits(target.storage_key, None, stat):
+                # read whole once to be kept, the range is cut from it
+                body = self._cached_stream(file_streamer(file_path), target.storage_key, None, file_path, stat)
+                return Stream(
+                    self._slice_stream(body, start, end),
+                    status_code=206,
+                    media_type=media_type,
+                    headers=headers_out,
+                )
+            return Stream(
+                file_streamer(file_path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers=headers_out,
+            )
+
+        boundary = uuid.uuid4().hex
+        length, body = multipart_ranges(file_path, ranges, size, media_type, boundary)
+        headers_out['Content-Length'] = str(length)
+        return Stream(
+            body,
+            status_code=206,
+            media_type=f'multipart/byteranges; boundary={boundary}',
+            headers=headers_out,
+        )
+
+    def _encoded_response(
+            self,
+            target: FSObject,
+            file_path: Path,
+            stat,
+            encoding: str,
+            media_type: str,
+            headers: dict,
+    ) -> Response | Stream:
+        """
+        Stream the compressed variant of `target`, from the variant cache if it is as recent as the file.
+        Otherwise the file is compressed while it is sent and the result kept as the variant.
+        """
+        headers = {**headers, 'Content-Encoding': encoding}
+        variant_path = self.storage.variant_path(target.ref_id, encoding)
+        try:
+            variant_stat = variant_path.stat()
+        except FileNotFoundError:
+            variant_stat = None
+        if variant_stat is not None and variant_stat.st_mtime >= stat.st_mtime:
+            contents = self.blob_cache.get(target.ref_id, encoding, variant_stat)
+            if contents is not None:
+                return Response(contents[:], media_type=media_type, headers=headers)
+            headers['Content-Length'] = str(variant_stat.st_size)
+            return Stream(
+                self._cached_stream(file_streamer(variant_path), target.ref_id, encoding, variant_path, variant_stat),
+                media_type=media_type,
+                headers=headers,
+            )
+        return Stream(self._compress_to_variant(file_path, variant_path, encoding), media_type=media_type, headers=headers)
+
+    async def _compress_to_variant(self, file_path: Path, variant_path: Path, encoding: str) -> AsyncIterator[bytes]:
+        compressor = COMPRESSORS[encoding]()
+        tmp_path = self.storage.temp_path()
+        await run_io(lambda: self.storage.tmp_dir.mkdir(parents=True, exist_ok=True))
+        f = await run_io(open, tmp_path, 'wb')
+        complete = False
+        try:
+            async for chunk in file_streamer(file_path):
+                chunk = await run_io(compressor.compress, chunk)
+                if chunk:
+                    await run_io(f.write, chunk)
+                    yield chunk
+            chunk = await run_io(compressor.flush)
+            await run_io(f.write, chunk)
+            yield chunk
+            complete = True
+        finally:
+            # also reached when the client goes away, the partial variant is dropped then
+            await run_io(self._finish_variant, f, tmp_path, variant_path, complete)
+
+    @staticmethod
+    def _finish_variant(f, tmp_path: Path, variant_path: Path, complete: bool) -> None:
+        f.close()
+        if complete:
+            variant_path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, variant_path)
+        else:
+            tmp_path.unlink(missing_ok=True)
+
+    async def _cached_stream(
+            self,
+            body: AsyncIterator[bytes],
+            key: str,
+            encoding: Optional[str],
+            file_path: Path,
+            stat,
+    ) -> AsyncIterator[bytes]:
+        """Pass the whole file on from `body`, keeping it in the blob cache if it is admitted."""
+        if not self.blob_cache.admits(key, encoding, stat):
+            async for chunk in body:
+                yield chunk
+            return
+        chunks = []
+        async for chunk in body:
+            chunks.append(chunk)
+            yield chunk
+        await run_io(self._keep_blob, key, encoding, file_path, stat, b''.join(chunks))
+
+    def _keep_blob(self, key: str, encoding: Optional[str], file_path: Path, stat, contents: bytes):
+        # what was read only counts as the file of `stat` if it is still that file
+        try:
+            if BlobCache.validator(file_path.stat()) != BlobCache.validator(stat):
+                return
+            mapped = self.blob_cache.map(file_path, stat)
+        except (OSError, ValueError):
+            return
+        self.blob_cache.put(key, encoding, stat, contents if mapped is None else mapped)
+
+    @staticmethod
+    async def _slice_stream(body: AsyncIterator[bytes], start: int, end: int) -> AsyncIterator[bytes]:
+        offset = 0
+        async for chunk in body:
+            if offset <= end and offset + len(chunk) > start:
+                yield chunk[max(start - offset, 0):end + 1 - offset]
+            offset += len(chunk)
+
+    @staticmethod
+    def _stat(file_path: Path):
+        try:
+            return file_path.stat()
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+
+    @staticmethod
+    def _if_range_matches(if_range: Optional[str], etag: str, last_modified: datetime) -> bool:
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            # strong comparison, a weak tag never matches
+            return if_range == etag
+        since = parse_http_date(if_range)
+        return since is not None and int(since.timestamp()) == int(last_modified.timestamp())
+
+    async def get_obj(
+            self,
+            full_path: str,
+            headers: Optional[Mapping[str, str]] = None,
+            page: Optional[ListingPage] = None,
+            archive: Optional[str] = None,
+            store: bool = False,
+    ) -> Response | Stream:
+        async with self.get_session() as session:
+            target = await session.get_by_path(full_path)
             if not target:
                 raise HTTPException(status_code=404)
 
             if target.type == FSObjectType.FILE:
-                ref_id = target.ref_id
-                return file_streamer(self.root_dir / ref_id)
+                return self.stream_file(target, headers or {})
 
             elif target.type == FSObjectType.DIR:
-                listdir = list(map(FSObjectDto.from_entity, target.children))
-                parent_dto = FSObjectDto.from_entity(target.parent)
-                parent_dto.name = '..'
-                listdir.append(parent_dto)
-                return listdir
+                if archive:
+                    return self.archive_response(target, archive, store)
+                return await self.listing_response(session, target, headers or {}, page)
 
             raise HTTPException(status_code=500)
 
-    async def get_obj_by_ref(self, ref_id: str) -> Iterable[FSObjectDto] | Stream:
-        with self.get_session() as session:
-            target = session.get_by_ref(ref_id)
+    async def get_obj_by_ref(
+            self,
+            ref_id: str,
+            headers: Optional[Mapping[str, str]] = None,
+            page: Optional[ListingPage] = None,
+            archive: Optional[str] = None,
+            store: bool = False,
+    ) -> Response | Stream:
+        async with self.get_session() as session:
+            target = await session.get_by_ref(ref_id)
             if not target:
                 raise HTTPException(status_code=404)
 
             if target.type == FSObjectType.FILE:
-                ref_id = target.ref_id
-                return Stream(
-                    file_streamer(self.root_dir / ref_id),
-                    media_type=get_mime_type(target.name),
-                )
+                return self.stream_file(target, headers or {})
             elif target.type == FSObjectType.DIR:
-                listdir = list(map(FSObjectDto.from_entity, target.children))
-                parent_dto = FSObjectDto.from_entity(target.parent)
-                parent_dto.name = '..'
-                listdir.append(parent_dto)
-                return listdir
+                if archive:
+                    return self.archive_response(target, archive, store)
+                return await self.listing_response(session, target, headers or {}, page)
 
             raise HTTPException(status_code=500)
 
-    def create_dir(self, full_path: str) -> DirDto:
-        with self.get_session() as session:
-            if session.exists_by_path(full_path):
+    async def search(
+            self,
+            term: str,
+            mode: str = 'substring',
+            scope: Optional[str] = None,
+            fs_type: Optional[str] = None,
+            page: Optional[ListingPage] = None,
+    ) -> Response:
+        """
+        Objects whose name matches `term`, below directory `scope` if given, a page at a time
+        in id order with the cursor of the next page in `X-Next-Cursor`.
+        """
+        if not term:
+            raise HTTPException(status_code=400, detail='empty search')
+        page = page or ListingPage(self.listing_page_size, 'id')
+        if scope is not None:
+            scope = '/' + scope.strip('/')
+        async with self.get_session() as session:
+            if scope is not None and scope != '/' and not await session.exists_by_path(scope):
+                raise HTTPException(status_code=404)
+            rows = await session.search(
+                term,
+                mode,
+                scope if scope != '/' else None,
+                FSObjectType(fs_type) if fs_type else None,
+                page.after[1] if page.after else 0,
+                page.limit + 1,
+            )
+
+        headers = {}
+        if len(rows) > page.limit:
+            rows = rows[:page.limit]
+            headers['X-Next-Cursor'] = page.next_cursor(rows[-1])
+        return Response(list(map(FSObjectDto.from_entity, rows)), media_type='application/json', headers=headers)
+
+    async def create_dir(self, full_path: str) -> DirDto:
+        async with self.get_session() as session:
+            if await session.exists_by_path(full_path):
                 raise HTTPException(status_code=400)
 
             last_slash = full_path.rfind('/')
@@ -78,98 +541,183 @@ class FSService:
                 parent_path = full_path[:last_slash]
             name = full_path[last_slash:]
 
-            parent = session.get_by_path(parent_path)
+            parent = await session.get_by_path(parent_path)
             if not parent:
                 raise HTTPException(status_code=400)
-            new_dir = session.create(FSObject(
+            new_dir = await session.create(FSObject(
                 name=name,
                 full_path=full_path,
                 ref_id=str(uuid.uuid4()).replace('-', ''),
                 type=FSObjectType.DIR,
-                parent=parent,
+                parent_id=parent.id,
             ))
-            return DirDto.from_entity(new_dir)
+            await session.touch(parent.id)
+            dto = DirDto.from_entity(new_dir)
+        await self.listing_cache.invalidate(dto.parent_id)
+        return dto
 
     async def create_file(self, target_dir, data) -> FileDto:
-        with self.get_session() as session:
-            parent = session.get_by_path(target_dir)
-            if not parent:
+        target_dir = target_dir if target_dir else '/'
+        async with self.get_session() as session:
+            if not await session.exists_by_path(target_dir):
                 raise HTTPException(status_code=400)
 
-            full_path = (Path(parent.full_path) / data.filename)
-            dup_idx = 0
-            while session.exists_by_path(full_path.as_posix()):
-                dup_idx += 1
-                full_path = full_path.with_stem(Path(data.filename).stem + f' ({dup_idx})')
-
-            print(full_path.as_posix())
-
-            ref_id = str(uuid.uuid4()).replace('-', '')
-            write_path = self.root_dir / ref_id
-
-            with open(write_path, 'wb') as f:
-                chunk_size = 1024 * 1024
-                chunk = await data.read(chunk_size)
-                while chunk:
-                    f.write(chunk)
-                    chunk = await data.read(chunk_size)
-
-            target_dir = target_dir if target_dir else '/'
-            parent = session.get_by_path(target_dir)
-            if not parent:
-                raise HTTPException(status_code=400)
-            new_file = session.create(FSObject(
-                name=data.filename,
-                full_path=full_path.as_posix(),
-                ref_id=ref_id,
-                type=FSObjectType.FILE,
-                parent=parent,
-            ))
-            return FileDto.from_entity(new_file)
+        # the upload itself runs without holding a database connection
+        tmp_path, size, content_hash = await self.storage.write_temp(data)
+        return await self.register_file(target_dir, data.filename, tmp_path, size, content_hash)
+
+    async def register_file(
+            self,
+            target_dir: str,
+            filename: str,
+            tmp_path: Path,
+            size: int,
+            content_hash: Optional[str] = None,
+    ) -> FileDto:
+        """
+        Register the contents written to `tmp_path` as file `filename` in `target_dir`,
+        numbering the name if it is taken, and move them into place.
+        The temporary file is gone afterwards, whether this succeeds or not.
+        """
+        if content_hash is None and self.dedupe:
+            content_hash = await run_io(hash_file, tmp_path)
+        committed_key = None
+        try:
+            async with self.get_session() as session:
+                parent = await session.get_by_path(target_dir)
+                if not parent:
+                    raise HTTPException(status_code=400)
+
+                full_path = (Path(parent.full_path) / filename)
+                dup_idx = 0
+                while await session.exists_by_path(full_path.as_posix()):
+                    dup_idx += 1
+                    full_path = full_path.with_stem(Path(filename).stem + f' ({dup_idx})')
+
+                ref_id = str(uuid.uuid4()).replace('-', '')
+                blob_hash = content_hash if self.dedupe else None
+                new_file = await session.create(FSObject(
+                    name=filename,
+                    full_path=full_path.as_posix(),
+                    ref_id=ref_id,
+                    type=FSObjectType.FILE,
+                    blob_hash=blob_hash,
+                    size=size,
+                    mime_type=get_mime_type(filename),
+                    content_hash=content_hash,
+                    parent_id=parent.id,
+                ))
+                await session.touch(parent.id)
+                if not blob_hash or await session.acquire_blob(blob_hash, size):
+                    await self.storage.commit(tmp_path, new_file.storage_key)
+                    committed_key = new_file.storage_key
+                dto = FileDto.from_entity(new_file)
+        except BaseException:
+            await self.storage.discard(tmp_path)
+            if committed_key and not blob_hash:
+                await self.storage.unlink(committed_key)
+            # a stored blob may already serve a concurrent upload of the same contents, jobs.gc removes it if not
+            raise
+        # identical contents were already stored
+        await self.storage.discard(tmp_path)
+        await self.listing_cache.invalidate(dto.parent_id)
+        return dto
 
     async def rename(self, full_path: str, new_name: str):
-        with self.get_session() as session:
-            target = session.get_by_path(full_path)
+        old_name_start = full_path.rfind('/') + 1
+        return await self.move(full_path, full_path[:old_name_start] + new_name)
+
+    async def move(self, full_path: str, new_path: str):
+        """
+        Rename `full_path` to `new_path`, reparenting it if the parent differs.
+        Directory descendants are rewritten with a single set based update.
+        """
+        if new_path != '/':
+            new_path = new_path.rstrip('/')
+        last_slash = new_path.rfind('/')
+        new_name = new_path[last_slash + 1:]
+        new_parent_path = new_path[:last_slash] or '/'
+        if last_slash < 0 or not new_name or new_name in ('.', '..'):
+            raise HTTPException(status_code=400)
+
+        async with self.get_session() as session:
+            target = await session.get_by_path(full_path)
             if not target:
                 raise HTTPException(status_code=404)
-
-            siblings = set(child.name for child in target.parent.children)
-            if new_name in siblings:
+            if target.parent_id is None:
                 raise HTTPException(status_code=400)
 
-            old_name_start = full_path.rfind('/') + 1
-            new_path = full_path[:old_name_start] + new_name
-            old_name_end = len(full_path)
-            target.name = new_name
-            target.full_path = new_path
-            if target.type == FSObjectType.FILE:
-                return FileDto.from_entity(target)
-
-            new_basepath = new_path
-            for child in session.read_all_descendants(full_path):
-                origin_path = child.full_path
-                renamed_path = new_basepath + origin_path[old_name_end:]
-                child.full_path = renamed_path
-
-            return DirDto.from_entity(target)
+            if new_path != full_path:
+                if await session.exists_by_path(new_path):
+                    raise HTTPException(status_code=400)
+                if target.type == FSObjectType.DIR and new_path.startswith(full_path + '/'):
+                    # cannot move a directory into itself
+                    raise HTTPException(status_code=400)
+                new_parent = await session.get_by_path(new_parent_path)
+                if not new_parent or new_parent.type != FSObjectType.DIR:
+                    raise HTTPException(status_code=400)
+
+                old_parent_id = target.parent_id
+                target.name = new_name
+                target.full_path = new_path
+                target.parent_id = new_parent.id
+                await session.touch(old_parent_id, new_parent.id)
+                if target.type == FSObjectType.FILE:
+                    target.mime_type = get_mime_type(new_name)
+                else:
+                    await session.move_descendants(full_path, new_path)
+                    # paths shown in every listing below have changed
+                    await session.touch(target.id)
+                    await session.touch_descendant_dirs(new_path)
+                invalidated = (old_parent_id, new_parent.id)
+
+            dto = FSObjectDto.from_entity(target)
+
+        if new_path == full_path:
+            return dto
+        if isinstance(dto, DirDto):
+            await self.listing_cache.invalidate()
+        else:
+            await self.listing_cache.invalidate(*invalidated)
+        return dto
 
     async def delete(self, full_path: str, rmtree: bool):
-        with self.get_session() as session:
-            target = session.get_by_path(full_path)
+        unlink_keys, released_blobs = [], []
+        async with self.get_session() as session:
+            target = await session.get_by_path(full_path)
             if not target:
                 raise HTTPException(status_code=404)
 
             if target.type == FSObjectType.FILE:
-                (self.root_dir / target.ref_id).unlink(missing_ok=True)
-                session.delete(target)
-                return
-
+                files = [(target.ref_id, target.blob_hash)]
             elif target.type == FSObjectType.DIR:
                 if not rmtree:
                     raise HTTPException(status_code=403)
-                for file in session.read_all_descendant_files(full_path):
-                    (self.root_dir / file.ref_id).unlink(missing_ok=True)
-                session.delete(target)
-                return
-
-            raise HTTPException(status_code=500)
+                files = await session.read_descendant_file_keys(full_path)
+            else:
+                raise HTTPException(status_code=500)
+
+            await session.touch(target.parent_id)
+            await session.delete_tree(target)
+
+            blob_refs = {}
+            for ref_id, blob_hash in files:
+                if blob_hash:
+                    blob_refs[blob_hash] = blob_refs.get(blob_hash, 0) + 1
+                else:
+                    unlink_keys.append(ref_id)
+            for blob_hash, count in blob_refs.items():
+                if await session.release_blob(blob_hash, count):
+                    # left on disk, a concurrent upload of the same contents may be storing it again right now,
+                    # jobs.gc removes it once no blob references it past the grace period
+                    released_blobs.append(blob_hash)
+            invalidated = (target.parent_id, target.id)
+
+        await self.listing_cache.invalidate(*invalidated)
+
+        # physical files go only once the rows are gone
+        self.blob_cache.invalidate(*unlink_keys, *released_blobs, *(ref_id for ref_id, _ in files))
+        for key in unlink_keys:
+            await self.storage.unlink(key)
+        for ref_id, _ in files:
+            await self.storage.unlink_variants(ref_id, COMPRESSORS)
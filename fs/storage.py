@@ -0,0 +1,200 @@
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from litestar.datastructures import UploadFile
+
+import config
+from utils import run_io
+
+
+class BlobStore:
+    """
+    Physical storage of file contents under root_dir.
+    New contents are written to a temporary file first,
+    then atomically moved into place once they are registered.
+
+    With a `shard_depth`, blobs are spread over nested directories named after
+    the leading characters of their key, `ab/cd/abcd...` for a depth of 2 and a width of 2.
+    Blobs still in the flat layout are found as well, so jobs.reshard can move them
+    while they are being served.
+    """
+
+    upload_chunk_size = 1024 * 1024
+
+    def __init__(
+            self,
+            root_dir: Path,
+            shard_depth: Optional[int] = None,
+            shard_width: Optional[int] = None,
+            dedupe: Optional[bool] = None,
+    ):
+        self.root_dir = root_dir
+        self.tmp_dir = root_dir / '.tmp'
+        self.variant_dir = root_dir / '.variants'
+        self.shard_depth = config.SHARD_DEPTH if shard_depth is None else shard_depth
+        self.shard_width = config.SHARD_WIDTH if shard_width is None else shard_width
+        dedupe = config.DEDUPE if dedupe is None else dedupe
+        # ref_ids are uuid4 hex, deduplicated blobs are named after their sha256 hex digest
+        self.key_pattern = re.compile('[0-9a-f]{32}|[0-9a-f]{64}' if dedupe else '[0-9a-f]{32}')
+        self.shard_pattern = re.compile(f'[0-9a-f]{{{self.shard_width}}}')
+
+    def canonical_path(self, key: str) -> Path:
+        """Where blob `key` belongs in the configured layout."""
+        path = self.root_dir
+        for level in range(self.shard_depth):
+            path = path / key[level * self.shard_width:(level + 1) * self.shard_width]
+        return path / key
+
+    def path(self, key: str) -> Path:
+        """Where blob `key` is, the flat layout is tried when it is not in the configured one."""
+        path = self.canonical_path(key)
+        if self.shard_depth and not path.exists():
+            flat_path = self.root_dir / key
+            if flat_path.exists():
+                return flat_path
+        return path
+
+    def temp_path(self) -> Path:
+        return self.tmp_dir / uuid.uuid4().hex
+
+    def variant_path(self, ref_id: str, encoding: str) -> Path:
+        """Compressed copy of the contents of file `ref_id`, see fs.compression."""
+        return self.variant_dir / f'{ref_id}.{encoding}'
+
+    async def unlink_variants(self, ref_id: str, encodings: Iterable[str]) -> None:
+        def unlink():
+            for encoding in encodings:
+                self.variant_path(ref_id, encoding).unlink(missing_ok=True)
+        await run_io(unlink)
+
+    async def write_temp(self, data: UploadFile) -> Tuple[Path, int, str]:
+        """
+        Stream an upload into a new temporary file,
+        returns its path, size and sha256 hex digest.
+        """
+        await run_io(lambda: self.tmp_dir.mkdir(parents=True, exist_ok=True))
+        tmp_path = self.temp_path()
+        size = 0
+        hasher = hashlib.sha256()
+        f = await run_io(open, tmp_path, 'wb')
+
+        def write(chunk: bytes):
+            f.write(chunk)
+            hasher.update(chunk)
+
+        try:
+            chunk = await data.read(self.upload_chunk_size)
+            while chunk:
+                await run_io(write, chunk)
+                size += len(chunk)
+                chunk = await data.read(self.upload_chunk_size)
+        except BaseException:
+            await run_io(f.close)
+            await self.discard(tmp_path)
+            raise
+        await run_io(f.close)
+        return tmp_path, size, hasher.hexdigest()
+
+    async def assemble(self, parts: Iterable[Path]) -> Tuple[Path, int]:
+        """
+        Concatenate `parts` into a new temporary file, returns its path and size.
+        Bytes are copied within the kernel with copy_file_range where the filesystem allows it.
+        """
+        await run_io(lambda: self.tmp_dir.mkdir(parents=True, exist_ok=True))
+        tmp_path = self.temp_path()
+        size = 0
+        out_fd = await run_io(os.open, tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            for part in parts:
+                size += await run_io(copy_into, part, out_fd, size)
+        except BaseException:
+            os.close(out_fd)
+            await self.discard(tmp_path)
+            raise
+        os.close(out_fd)
+        return tmp_path, size
+
+    async def commit(self, tmp_path: Path, key: str) -> Path:
+        target = self.canonical_path(key)
+
+        def replace():
+            if self.shard_depth:
+                target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, target)
+        await run_io(replace)
+        return target
+
+    async def discard(self, tmp_path: Path) -> None:
+        await run_io(lambda: tmp_path.unlink(missing_ok=True))
+
+    async def unlink(self, key: str) -> None:
+        def unlink():
+            self.canonical_path(key).unlink(missing_ok=True)
+            if self.shard_depth:
+                (self.root_dir / key).unlink(missing_ok=True)
+        await run_io(unlink)
+
+    def scan(self, batch_size: int = 1000) -> Iterator[List[os.DirEntry]]:
+        """
+        Walk the stored blobs in batches of directory entries without listing root_dir at once,
+        in the flat layout and in shard directories alike.
+        Only files named like a blob key are blobs, and only directories named like a shard
+        within SHARD_DEPTH levels are walked, whatever else lives in root_dir is left out.
+        """
+        batch = []
+        for entry in self._walk(self.root_dir, 0):
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _walk(self, directory: Path, level: int) -> Iterator[os.DirEntry]:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if self.key_pattern.fullmatch(entry.name):
+                    if entry.is_file(follow_symlinks=False):
+                        yield entry
+                elif level < self.shard_depth and self.shard_pattern.fullmatch(entry.name):
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._walk(Path(entry.path), level + 1)
+
+
+def copy_into(source: Path, out_fd: int, offset: int) -> int:
+    """Copy all of `source` to `out_fd` at `offset`, returns the number of bytes copied."""
+    with open(source, 'rb') as f:
+        remaining = os.fstat(f.fileno()).st_size
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while remaining > 0:
+                    n = os.copy_file_range(f.fileno(), out_fd, remaining, copied, offset + copied)
+                    if n == 0:
+                        break
+                    copied += n
+                    remaining -= n
+                return copied
+            except OSError:
+                # not supported between these files, copy through userspace
+                pass
+        f.seek(copied)
+        while chunk := f.read(1024 * 1024):
+            view = memoryview(chunk)
+            while view:
+                n = os.pwrite(out_fd, view, offset + copied)
+                copied += n
+                view = view[n:]
+        return copied
+
+
+def hash_file(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -1,22 +1,40 @@
+import hashlib
 from pathlib import Path
 
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+
+import config
 from fs.models import FSObject, Base
 from fs.repo import FSRepository
-from singletons import root_dir, repo_factory
-from utils import create_key
+from fs.search import POSTGRES_DDL, SQLITE_DDL, ensure_search_index
+from jobs.reconcile import Reconciler
+from singletons import (
+    root_dir, repo_factory, async_repo_factory, async_redis_connection, listing_cache, garbage_collector,
+)
+from utils import FileLock, create_key, get_decoder, get_handshake
+
+# any number, the same for every server sharing a postgres database
+SCHEMA_LOCK_KEY = 0x66737264
+
+# background jobs run in one worker only, the first to take this lock, for as long as it lives
+leader_lock = FileLock(Path(config.STATE_DIR) / 'leader.lock')
 
 
 def check_schema():
     """
     Check the database of connection string to see if required tables exists
     Create if it doesn't exist
+    On postgres this is done under an advisory lock, so servers sharing the database do not race.
     """
-
-    # connected with Repository
-    inspector = repo_factory.inspector
-    if not inspector.has_table(FSObject.__tablename__):
-        print('table does not exist, creating')
-        Base.metadata.create_all(repo_factory.engine)
+    with repo_factory.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+        if not inspect(conn).has_table(FSObject.__tablename__):
+            print('table does not exist, creating')
+        Base.metadata.create_all(conn)
+        migrate_schema(conn)
+        ensure_search_index(conn)
 
     with repo_factory(FSRepository) as session:
         if not session.get_by_path('/'):
@@ -24,6 +42,60 @@ def check_schema():
             session.create_root()
 
 
+def migrate_schema(conn):
+    """
+    Bring tables created by an older version up to date,
+    adding the columns and indexes that were introduced since.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            print(f'adding column {table.name}.{column.name}')
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def schema_fingerprint() -> str:
+    """Changes with the database and with the tables, columns and indexes this version expects."""
+    parts = [config.DB_URL, *SQLITE_DDL, *POSTGRES_DDL]
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(sorted(column.name for column in table.columns))
+        parts.extend(sorted(index.name for index in table.indexes))
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def root_exists() -> bool:
+    try:
+        with repo_factory(FSRepository) as session:
+            return session.get_by_path('/') is not None
+    except SQLAlchemyError:
+        return False
+
+
+def prepare():
+    """
+    One-time setup of root_dir, the schema and the key. The first worker to start does it
+    while the others wait for the lock, then find it done.
+    The schema is only checked when this version has not done so before, as recorded in STATE_DIR,
+    or when the root directory is missing.
+    """
+    state_dir = Path(config.STATE_DIR)
+    with FileLock(state_dir / 'init.lock'):
+        check_fs()
+        marker = state_dir / 'schema'
+        fingerprint = schema_fingerprint()
+        if not (marker.exists() and marker.read_text() == fingerprint and root_exists()):
+            check_schema()
+            marker.write_text(fingerprint)
+        create_key()
+
+
 def check_fs():
     """
     Configure filesystem or fail
@@ -34,23 +106,38 @@ def check_fs():
         raise FileExistsError(f'{root_dir} exists and is not a directory')
 
 
-def compare_fs_db(root_dir: Path):
+def compare_fs_db(root_dir: Path, background: bool = False):
     """
     starting with root_dir, compare database records with the actual filesystem.
+    The report of missing files and orphaned blobs is written under STATE_DIR,
+    see jobs.reconcile.
     """
-    fs_pool = set(obj.name for obj in root_dir.iterdir())
-    with repo_factory(FSRepository) as session:
-        missing = set(entity for entity in session.read_all_descendant_files() if entity.ref_id not in fs_pool)
-        # TODO create a report
-        for file in missing:
-            print(f'Logical file: {file.full_path} (physical: {file.ref_id}) is missing')
+    reconciler = Reconciler(root_dir, repo_factory, Path(config.STATE_DIR), config.RECONCILE_BATCH_SIZE)
+    if background:
+        reconciler.start()
+    else:
+        reconciler.run()
 
 
 def init():
-    check_fs()
-    check_schema()
-    compare_fs_db(root_dir)
-    create_key()
+    prepare()
+    # loaded once per worker, before the first request needs them
+    get_decoder()
+    get_handshake()
+    listing_cache.start_listener()
+    if leader_lock.acquire(blocking=False):
+        if config.RECONCILE_ON_STARTUP:
+            compare_fs_db(root_dir, background=True)
+        if config.GC_INTERVAL > 0:
+            garbage_collector.start(config.GC_INTERVAL)
+
+
+async def shutdown():
+    listing_cache.stop_listener()
+    garbage_collector.stop()
+    leader_lock.release()
+    await async_repo_factory.dispose()
+    await async_redis_connection.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+"""
+Fill in size, mime type, checksum and timestamps of files uploaded
+before that metadata was recorded.
+
+    python -m jobs.backfill [--batch-size 500] [--skip-hash]
+
+Files are processed in id order and each batch is committed on its own,
+so the job can be interrupted and run again.
+"""
+import argparse
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fs.repo import FSRepository
+from fs.storage import BlobStore, hash_file
+from singletons import repo_factory, root_dir
+from utils import get_mime_type
+
+
+def backfill(root_dir: Path, batch_size: int = 500, skip_hash: bool = False):
+    storage = BlobStore(root_dir)
+    filled, missing = 0, 0
+    last_id = 0
+    while True:
+        with repo_factory(FSRepository) as session:
+            batch = list(session.read_files_without_metadata(last_id, batch_size))
+            if not batch:
+                break
+
+            for entity in batch:
+                last_id = entity.id
+                file_path = storage.path(entity.storage_key)
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:
+                    print(f'Logical file: {entity.full_path} (physical: {entity.storage_key}) is missing')
+                    missing += 1
+                    continue
+
+                modified_at = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+                entity.size = stat.st_size
+                entity.mime_type = get_mime_type(entity.name)
+                entity.modified_at = modified_at
+                entity.created_at = entity.created_at or modified_at
+                if entity.blob_hash:
+                    entity.content_hash = entity.blob_hash
+                elif not skip_hash:
+                    entity.content_hash = hash_file(file_path)
+                filled += 1
+
+    print(f'filled metadata of {filled} files, {missing} missing')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='backfill file metadata')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--skip-hash', action='store_true', help='do not read file contents to compute checksums')
+    args = parser.parse_args()
+    backfill(root_dir, args.batch_size, args.skip_hash)
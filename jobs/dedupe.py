@@ -0,0 +1,76 @@
+"""
+Convert the files already in root_dir to content addressed storage.
+
+    python -m jobs.dedupe [--batch-size 500]
+
+Every file without a blob is hashed, linked to the blob `<sha256>` (or attached
+to the existing blob of the same contents) and its own copy removed.
+Each file is committed on its own, so the job can be interrupted and run again.
+Set DEDUPE=true so new uploads are stored the same way.
+"""
+import argparse
+import os
+import shutil
+from pathlib import Path
+
+from fs.repo import FSRepository
+from fs.storage import BlobStore, hash_file
+from singletons import repo_factory, root_dir
+
+
+def link_blob(source: Path, target: Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        # left over by an interrupted run, contents are the same by hash
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def dedupe(root_dir: Path, batch_size: int = 500):
+    storage = BlobStore(root_dir)
+    converted, shared, missing, saved = 0, 0, 0, 0
+    last_id = 0
+    while True:
+        with repo_factory(FSRepository) as session:
+            batch = [(entity.id, entity.ref_id) for entity in session.read_files_without_blob(last_id, batch_size)]
+        if not batch:
+            break
+
+        for pk, ref_id in batch:
+            last_id = pk
+            source = storage.path(ref_id)
+            if not source.exists():
+                print(f'physical file {ref_id} is missing, skipping')
+                missing += 1
+                continue
+
+            size = source.stat().st_size
+            content_hash = hash_file(source)
+            with repo_factory(FSRepository) as session:
+                entity = session.get_by_id(pk)
+                if entity is None or entity.blob_hash:
+                    continue
+                created = session.acquire_blob(content_hash, size)
+                if created:
+                    link_blob(source, storage.canonical_path(content_hash))
+                entity.blob_hash = content_hash
+
+            source.unlink(missing_ok=True)
+            if created:
+                converted += 1
+            else:
+                shared += 1
+                saved += size
+
+    print(f'converted {converted} files, {shared} shared an existing blob '
+          f'({saved} bytes reclaimed), {missing} missing')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='deduplicate existing files in root_dir')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    dedupe(root_dir, args.batch_size)
@@ -0,0 +1,257 @@
+"""
+Remove physical files in root_dir that no file record or blob references.
+
+    python -m jobs.gc [--grace-period 86400] [--rate 100] [--scan-rate 10000] [--batch-size 1000] [--dry-run]
+
+Failed uploads, crashes between the database and the filesystem and lost races leave
+such files behind, and deduplicated blobs are only ever removed here, once their last reference
+is gone, as an upload of the same contents may store them again meanwhile. Files younger than the grace period are never touched, as they may
+belong to an upload that has not committed yet. The same holds for leftovers in `.tmp`
+and for compressed variants in `.variants` whose file is gone. Resumable uploads
+in `.uploads` are dropped once they have not received a part for `upload_ttl` seconds.
+root_dir is walked in batches, so memory stays bounded whatever its size,
+scanning is throttled to `scan_rate` entries per second, one batch at a time,
+and removals to `rate` files per second.
+Only files named like blob keys count as blobs, see BlobStore.scan,
+so a database or anything else kept in root_dir is never removed.
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from fs.repo import FSRepository, RepositoryFactory
+from fs.storage import BlobStore
+
+
+class GarbageCollector:
+    def __init__(
+            self,
+            root_dir: Path,
+            repo_factory: RepositoryFactory,
+            grace_period: float = 86400,
+            rate: float = 100,
+            batch_size: int = 1000,
+            dry_run: bool = False,
+            upload_ttl: float = 7 * 86400,
+            scan_rate: float = 10000,
+    ):
+        self.storage = BlobStore(root_dir)
+        self.repo_factory = repo_factory
+        self.grace_period = grace_period
+        self.rate = rate
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.upload_ttl = upload_ttl
+        self.scan_rate = scan_rate
+        self.uploads_dir = root_dir / '.uploads'
+        self._stop = threading.Event()
+        self._next_at = 0.
+        self._scan_next_at = 0.
+
+    def _wait(self, next_at: float, count: int, rate: float) -> float:
+        # sleeps until next_at and returns when the following count items may go
+        if rate <= 0:
+            return next_at
+        now = time.monotonic()
+        if next_at > now:
+            self._stop.wait(next_at - now)
+        return max(now, next_at) + count / rate
+
+    def _throttle(self):
+        self._next_at = self._wait(self._next_at, 1, self.rate)
+
+    def _throttle_scan(self, count: int):
+        self._scan_next_at = self._wait(self._scan_next_at, count, self.scan_rate)
+
+    @staticmethod
+    def _age(stat: os.stat_result, now: float) -> float:
+        # ctime moves on hard links too, which keep the mtime of their source
+        return now - max(stat.st_mtime, stat.st_ctime)
+
+    def _remove(self, path: Path, size: int) -> bool:
+        self._throttle()
+        if self.dry_run:
+            print(f'would remove {path} ({size} bytes)')
+            return True
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def collect_blobs(self) -> tuple:
+        removed, reclaimed = 0, 0
+        for batch in self.storage.scan(self.batch_size):
+            # each batch costs a stat per entry and a query
+            self._throttle_scan(len(batch))
+            if self._stop.is_set():
+                break
+            now = time.time()
+            candidates = {}
+            for entry in batch:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if self._age(stat, now) >= self.grace_period:
+                    candidates[entry.name] = (Path(entry.path), stat)
+            if not candidates:
+                continue
+
+            with self.repo_factory(FSRepository) as session:
+                referenced = session.referenced_keys(candidates)
+            for key, (path, stat) in candidates.items():
+                if key in referenced or self._stop.is_set():
+                    continue
+                # replaced since the scan, by an upload registering the same contents
+                try:
+                    current = path.stat()
+                except FileNotFoundError:
+                    continue
+                if current.st_ino != stat.st_ino or current.st_ctime != stat.st_ctime:
+                    continue
+                if self._remove(path, stat.st_size):
+                    removed += 1
+                    reclaimed += stat.st_size
+        return removed, reclaimed
+
+    def collect_temp(self) -> tuple:
+        removed, reclaimed = 0, 0
+        if not self.storage.tmp_dir.is_dir():
+            return removed, reclaimed
+        now = time.time()
+        with os.scandir(self.storage.tmp_dir) as entries:
+            for entry in entries:
+                if self._stop.is_set():
+                    break
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if self._age(stat, now) < self.grace_period:
+                    continue
+                if self._remove(Path(entry.path), stat.st_size):
+                    removed += 1
+                    reclaimed += stat.st_size
+        return removed, reclaimed
+
+    def collect_variants(self) -> tuple:
+        removed, reclaimed = 0, 0
+        if not self.storage.variant_dir.is_dir():
+            return removed, reclaimed
+        batch = []
+
+        def collect_batch():
+            nonlocal removed, reclaimed
+            with self.repo_factory(FSRepository) as session:
+                existing = session.existing_ref_ids(set(ref_id for ref_id, _, _ in batch))
+            for ref_id, path, size in batch:
+                if ref_id in existing or self._stop.is_set():
+                    continue
+                if self._remove(path, size):
+                    removed += 1
+                    reclaimed += size
+            batch.clear()
+
+        now, scanned = time.time(), 0
+        with os.scandir(self.storage.variant_dir) as entries:
+            for entry in entries:
+                if scanned % self.batch_size == 0:
+                    self._throttle_scan(self.batch_size)
+                scanned += 1
+                if self._stop.is_set():
+                    break
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if self._age(stat, now) < self.grace_period:
+                    continue
+                # named <ref_id>.<encoding>
+                batch.append((entry.name.partition('.')[0], Path(entry.path), stat.st_size))
+                if len(batch) >= self.batch_size:
+                    collect_batch()
+        if batch:
+            collect_batch()
+        return removed, reclaimed
+
+    def collect_uploads(self) -> tuple:
+        removed, reclaimed = 0, 0
+        if not self.uploads_dir.is_dir():
+            return removed, reclaimed
+        now = time.time()
+        with os.scandir(self.uploads_dir) as entries:
+            for entry in entries:
+                if self._stop.is_set():
+                    break
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    # every part received touches the directory, and so does completing the upload
+                    if now - entry.stat(follow_symlinks=False).st_mtime < max(self.upload_ttl, self.grace_period):
+                        continue
+                    size = sum(part.stat().st_size for part in Path(entry.path).iterdir())
+                except FileNotFoundError:
+                    continue
+                self._throttle()
+                if self.dry_run:
+                    print(f'would remove upload {entry.path} ({size} bytes)')
+                else:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+                reclaimed += size
+        return removed, reclaimed
+
+    def collect(self):
+        started = time.monotonic()
+        blobs, blob_bytes = self.collect_blobs()
+        temps, temp_bytes = self.collect_temp()
+        variants, variant_bytes = self.collect_variants()
+        uploads, upload_bytes = self.collect_uploads()
+        verb = 'would remove' if self.dry_run else 'removed'
+        print(f'gc {verb} {blobs} orphaned blobs, {temps} temporary files, {variants} variants '
+              f'and {uploads} abandoned uploads, {blob_bytes + temp_bytes + variant_bytes + upload_bytes} bytes '
+              f'in {time.monotonic() - started:.1f}s')
+
+    def start(self, interval: float) -> threading.Thread:
+        """Collect every `interval` seconds in a daemon thread until `stop`."""
+        thread = threading.Thread(target=self._run_every, args=(interval,), name='gc', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _run_every(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.collect()
+            except Exception as e:
+                print(f'gc failed, retrying in {interval}s: {e!r}')
+
+
+if __name__ == '__main__':
+    import config
+    from singletons import repo_factory, root_dir
+
+    parser = argparse.ArgumentParser(description='remove unreferenced files from root_dir')
+    parser.add_argument('--grace-period', type=float, default=config.GC_GRACE_PERIOD,
+                        help='seconds a file must be untouched before it is removed')
+    parser.add_argument('--rate', type=float, default=config.GC_RATE,
+                        help='files removed per second at most, 0 for no limit')
+    parser.add_argument('--scan-rate', type=float, default=config.GC_SCAN_RATE,
+                        help='entries scanned per second at most, 0 for no limit')
+    parser.add_argument('--batch-size', type=int, default=config.GC_BATCH_SIZE)
+    parser.add_argument('--upload-ttl', type=float, default=config.UPLOAD_TTL,
+                        help='seconds without a new part after which an upload is abandoned')
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be removed')
+    args = parser.parse_args()
+    GarbageCollector(
+        root_dir, repo_factory, args.grace_period, args.rate, args.batch_size, args.dry_run, args.upload_ttl,
+        args.scan_rate,
+    ).collect()
@@ -0,0 +1,144 @@
+"""
+Reconcile database records with the physical files in root_dir.
+
+    python -m jobs.reconcile [--batch-size 1000] [--restart]
+
+Two passes, each in bounded memory:
+  - every file record is checked for its physical file (missing files),
+  - every blob on disk is checked for a record or blob referencing it (orphaned blobs),
+    files not named like blob keys are not blobs, see BlobStore.scan.
+Progress is checkpointed after each batch to `STATE_DIR/reconcile.json`,
+so an interrupted run resumes where it stopped. Findings are written as JSON lines
+to `STATE_DIR/reconcile-<run>.jsonl`.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fs.repo import FSRepository, RepositoryFactory
+from fs.storage import BlobStore
+
+
+def write_json(path: Path, data: dict):
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+class Reconciler:
+    def __init__(
+            self,
+            root_dir: Path,
+            repo_factory: RepositoryFactory,
+            state_dir: Path,
+            batch_size: int = 1000,
+    ):
+        self.storage = BlobStore(root_dir)
+        self.repo_factory = repo_factory
+        self.state_dir = state_dir
+        self.state_path = state_dir / 'reconcile.json'
+        self.batch_size = batch_size
+        self.state = None
+
+    def load_state(self, restart: bool = False) -> dict:
+        if not restart and self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+            if state.get('phase') != 'done':
+                print(f'resuming reconcile run {state["run"]} at {state["phase"]}')
+                return state
+        run = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        return {'run': run, 'phase': 'records', 'last_id': 0, 'scanned': 0, 'missing': 0, 'orphaned': 0}
+
+    def save_state(self):
+        write_json(self.state_path, self.state)
+
+    @property
+    def report_path(self) -> Path:
+        return self.state_dir / f'reconcile-{self.state["run"]}.jsonl'
+
+    def report(self, report, **finding):
+        report.write(json.dumps(finding) + '\n')
+
+    def run(self, restart: bool = False):
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.state = self.load_state(restart)
+        with open(self.report_path, 'a') as report:
+            if self.state['phase'] == 'records':
+                self.check_records(report)
+                self.state.update(phase='blobs')
+                self.save_state()
+            if self.state['phase'] == 'blobs':
+                self.check_blobs(report)
+            self.state.update(phase='done', finished=datetime.now(timezone.utc).isoformat())
+            self.report(report, kind='summary', missing=self.state['missing'], orphaned=self.state['orphaned'])
+        self.save_state()
+        print(f'reconcile {self.state["run"]}: {self.state["missing"]} missing files, '
+              f'{self.state["orphaned"]} orphaned blobs, report at {self.report_path}')
+
+    def check_records(self, report):
+        while True:
+            # a short transaction per batch, a long running read would hold off writers on sqlite
+            with self.repo_factory(FSRepository) as session:
+                batch = list(session.stream_file_keys(self.state['last_id'], self.batch_size))
+            if not batch:
+                return
+            for pk, full_path, ref_id, blob_hash in batch:
+                key = blob_hash or ref_id
+                if not self.storage.path(key).exists():
+                    self.report(report, kind='missing', full_path=full_path, key=key)
+                    self.state['missing'] += 1
+                self.state['last_id'] = pk
+            report.flush()
+            self.save_state()
+
+    def check_blobs(self, report):
+        # scandir order is stable while the directory is unchanged, so skipping
+        # the entries counted before the interruption resumes at the same spot
+        to_skip = self.state['scanned']
+        for batch in self.storage.scan(self.batch_size):
+            if to_skip >= len(batch):
+                to_skip -= len(batch)
+                continue
+            batch, to_skip = batch[to_skip:], 0
+
+            with self.repo_factory(FSRepository) as session:
+                referenced = session.referenced_keys(entry.name for entry in batch)
+            for entry in batch:
+                if entry.name in referenced:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                self.report(report, kind='orphan', key=entry.name, size=stat.st_size, mtime=stat.st_mtime)
+                self.state['orphaned'] += 1
+            self.state['scanned'] += len(batch)
+            report.flush()
+            self.save_state()
+
+    def start(self, restart: bool = False) -> threading.Thread:
+        """Run in a daemon thread, so the server does not wait for it."""
+        thread = threading.Thread(target=self._run_logged, args=(restart,), name='reconcile', daemon=True)
+        thread.start()
+        return thread
+
+    def _run_logged(self, restart: bool):
+        started = time.monotonic()
+        try:
+            self.run(restart)
+        except Exception as e:
+            print(f'reconcile stopped, it resumes on the next start: {e!r}')
+            return
+        print(f'reconcile took {time.monotonic() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    import config
+    from singletons import repo_factory, root_dir
+
+    parser = argparse.ArgumentParser(description='reconcile database records with root_dir')
+    parser.add_argument('--batch-size', type=int, default=config.RECONCILE_BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help='start over instead of resuming')
+    args = parser.parse_args()
+    Reconciler(root_dir, repo_factory, Path(config.STATE_DIR), args.batch_size).run(args.restart)
@@ -0,0 +1,91 @@
+"""
+Move the blobs in root_dir to the layout set by SHARD_DEPTH and SHARD_WIDTH.
+
+    python -m jobs.reshard [--batch-size 1000] [--settle 60]
+
+Runs while the server keeps serving. Each blob is first hard linked at its new place,
+which readers look up first, and its old name is only removed in a second pass once
+`settle` seconds have passed, so a request that resolved the old name just before
+still finds it. Both passes skip what is already done, the job can be interrupted
+and run again.
+Readers fall back to the flat layout only, going from a sharded layout back to
+a flat one or to another fan-out should be done with the server stopped.
+"""
+import argparse
+import os
+import shutil
+import time
+from pathlib import Path
+
+from fs.storage import BlobStore
+
+
+def place(storage: BlobStore, source: Path, target: Path) -> bool:
+    """Link `source` at `target`, False if it was deleted since the scan."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # no hard links on this filesystem, copy aside and move the copy in place
+        storage.tmp_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = storage.temp_path()
+        try:
+            shutil.copyfile(source, tmp_path)
+        except FileNotFoundError:
+            tmp_path.unlink(missing_ok=True)
+            return False
+        os.replace(tmp_path, target)
+    return True
+
+
+def reshard(root_dir: Path, batch_size: int = 1000, settle: float = 60):
+    storage = BlobStore(root_dir)
+    if not storage.shard_depth:
+        print('SHARD_DEPTH is 0, blobs stay in the flat layout')
+
+    linked = 0
+    for batch in storage.scan(batch_size):
+        for entry in batch:
+            target = storage.canonical_path(entry.name)
+            if Path(entry.path) == target or target.exists():
+                continue
+            if place(storage, Path(entry.path), target):
+                linked += 1
+        print(f'{linked} blobs linked into place')
+
+    if linked:
+        print(f'waiting {settle}s for requests still using the old names')
+        time.sleep(settle)
+
+    removed = 0
+    for batch in storage.scan(batch_size):
+        for entry in batch:
+            source = Path(entry.path)
+            target = storage.canonical_path(entry.name)
+            if source == target:
+                continue
+            try:
+                if not target.exists() or target.stat().st_size != entry.stat(follow_symlinks=False).st_size:
+                    # not linked yet, left for the next run
+                    continue
+                source.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+        print(f'{removed} old names removed')
+    print(f'resharded {linked} blobs, removed {removed} old names')
+
+
+if __name__ == '__main__':
+    from singletons import root_dir
+
+    parser = argparse.ArgumentParser(description='move blobs in root_dir to the configured shard layout')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--settle', type=float, default=60,
+                        help='seconds between linking the new names and removing the old ones')
+    args = parser.parse_args()
+    reshard(root_dir, args.batch_size, args.settle)
@@ -0,0 +1,89 @@
+"""
+Prometheus metrics of the server, exposed on /metrics.
+Route latency and request counts come from litestar's PrometheusMiddleware,
+what it can not see from outside the handlers is recorded here.
+"""
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+REQUEST_BYTES = Counter('fs_reader_request_body_bytes', 'Request body bytes received', ['path'])
+RESPONSE_BYTES = Counter('fs_reader_response_body_bytes', 'Response body bytes sent', ['path'])
+ACTIVE_STREAMS = Gauge('fs_reader_active_streams', 'Responses sent in more than one chunk still going on', ['path'])
+FILE_READ_BYTES = Counter('fs_reader_file_read_bytes', 'Bytes read from files being streamed')
+FILE_READ_TIME = Histogram('fs_reader_file_read_seconds', 'Duration of one chunk read of a streamed file',
+                           buckets=FAST_BUCKETS)
+
+DB_QUERY_TIME = Histogram('fs_reader_db_query_seconds', 'Duration of database statements', ['statement'],
+                          buckets=FAST_BUCKETS)
+DB_REQUEST_QUERIES = Histogram('fs_reader_db_queries_per_request', 'Database statements run by one request', ['path'],
+                               buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64, 128))
+DB_REQUEST_TIME = Histogram('fs_reader_db_seconds_per_request', 'Time one request spent in database statements',
+                            ['path'], buckets=FAST_BUCKETS)
+
+REDIS_TIME = Histogram('fs_reader_redis_seconds', 'Round trip of redis commands', ['command'], buckets=FAST_BUCKETS)
+AUTH_DECRYPT_TIME = Histogram('fs_reader_auth_decrypt_seconds', 'Opening the sealed box of a bearer token',
+                              buckets=FAST_BUCKETS)
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_seconds: float = 0.
+
+
+# stats of the request being served, None outside of requests
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement run on `engine`, a synchronous engine or the sync_engine of an asyncio one."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        DB_QUERY_TIME.labels(statement.split(None, 1)[0].lower()).observe(elapsed)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+
+class CacheCollector:
+    """Size, hits, misses and evictions of in-process caches, read when scraped."""
+
+    def __init__(self):
+        self.caches: Dict[str, object] = {}
+
+    def add(self, name: str, cache) -> None:
+        self.caches[name] = cache
+
+    def collect(self):
+        size = GaugeMetricFamily('fs_reader_cache_entries', 'Entries held by the cache', labels=['cache'])
+        hits = CounterMetricFamily('fs_reader_cache_hits', 'Lookups answered by the cache', labels=['cache'])
+        misses = CounterMetricFamily('fs_reader_cache_misses', 'Lookups the cache could not answer', labels=['cache'])
+        evictions = CounterMetricFamily('fs_reader_cache_evictions', 'Entries dropped for room', labels=['cache'])
+        used = GaugeMetricFamily('fs_reader_cache_bytes', 'Bytes held by byte budgeted caches', labels=['cache'])
+        for name, cache in self.caches.items():
+            size.add_metric([name], len(cache))
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            evictions.add_metric([name], cache.evictions)
+            if hasattr(cache, 'used_bytes'):
+                used.add_metric([name], cache.used_bytes)
+        return [size, hits, misses, evictions, used]
+
+
+cache_collector = CacheCollector()
+REGISTRY.register(cache_collector)
@@ -0,0 +1,88 @@
+"""
+Per request accounting of body bytes, streams and database statements,
+and sampling profiles of single requests.
+
+With PROFILE_REQUESTS on and pyinstrument installed (the `profiling` extra),
+a request sent with `X-Profile: 1` is profiled while it is served, streaming included.
+The profile is written to PROFILE_DIR as html, its file name is in the `X-Profile` response header.
+"""
+import re
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from litestar.datastructures import MutableScopeHeaders
+from litestar.middleware import AbstractMiddleware
+from litestar.types import Message, Receive, Scope, Send
+
+import config
+from utils import run_io
+from .collectors import (
+    ACTIVE_STREAMS, DB_REQUEST_QUERIES, DB_REQUEST_TIME, REQUEST_BYTES, RESPONSE_BYTES, RequestStats, request_stats,
+)
+
+
+class MetricsMiddleware(AbstractMiddleware):
+    exclude = ['^/metrics$']
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # the route template, not the path, keeps the label values bounded
+        path = scope.get('path_template') or scope['path']
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        streaming = False
+        profiler, profile_name = self._profiler(scope)
+
+        async def counted_receive() -> Message:
+            message = await receive()
+            if message['type'] == 'http.request':
+                REQUEST_BYTES.labels(path).inc(len(message.get('body', b'')))
+            return message
+
+        async def counted_send(message: Message) -> None:
+            nonlocal streaming
+            if message['type'] == 'http.response.start' and profiler is not None:
+                MutableScopeHeaders.from_message(message)['X-Profile'] = profile_name
+            elif message['type'] == 'http.response.body':
+                RESPONSE_BYTES.labels(path).inc(len(message.get('body', b'')))
+                more_body = message.get('more_body', False)
+                if more_body and not streaming:
+                    streaming = True
+                    ACTIVE_STREAMS.labels(path).inc()
+                elif not more_body and streaming:
+                    streaming = False
+                    ACTIVE_STREAMS.labels(path).dec()
+            await send(message)
+
+        if profiler is not None:
+            profiler.start()
+        try:
+            await self.app(scope, counted_receive, counted_send)
+        finally:
+            if streaming:
+                ACTIVE_STREAMS.labels(path).dec()
+            request_stats.reset(token)
+            DB_REQUEST_QUERIES.labels(path).observe(stats.queries)
+            DB_REQUEST_TIME.labels(path).observe(stats.db_seconds)
+            if profiler is not None:
+                profiler.stop()
+                await run_io(self._write_profile, profiler, profile_name)
+
+    @staticmethod
+    def _profiler(scope: Scope) -> tuple[Optional[Any], Optional[str]]:
+        if not config.PROFILE_REQUESTS or (b'x-profile', b'1') not in scope['headers']:
+            return None, None
+        try:
+            # imported only once profiling is asked for, it takes a while
+            from pyinstrument import Profiler
+        except ImportError:
+            return None, None
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', scope['path']).strip('-')[:80] or 'root'
+        name = f'{time.strftime("%Y%m%dT%H%M%S")}-{time.monotonic_ns() % 1000000:06d}-{slug}.html'
+        return Profiler(interval=config.PROFILE_INTERVAL, async_mode='enabled'), name
+
+    @staticmethod
+    def _write_profile(profiler, name: str) -> None:
+        profile_dir = Path(config.PROFILE_DIR)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        (profile_dir / name).write_text(profiler.output_html())
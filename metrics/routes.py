@@ -0,0 +1,16 @@
+from litestar.plugins.prometheus import PrometheusConfig, PrometheusController
+
+# latency histograms and request counts per route template
+prometheus_config = PrometheusConfig(
+    app_name='litestar-fs-reader',
+    prefix='fs_reader',
+    group_path=True,
+    exclude=['^/metrics$'],
+)
+
+
+class MetricsController(PrometheusController):
+    path = '/metrics'
+
+
+handlers = [MetricsController]
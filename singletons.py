@@ -1,14 +1,27 @@
 from pathlib import Path
 
 import redis
+import redis.asyncio
 
 import config
-from fs.repo import RepositoryFactory
+from fs.cache import BlobCache, ListingCache
+from fs.repo import AsyncRepositoryFactory, RepositoryFactory
 from fs.service import FSService
+from jobs.gc import GarbageCollector
+from metrics.collectors import cache_collector, instrument_engine
+from upload.service import UploadService
 
-repo_factory = RepositoryFactory(config.DB_URL)
+# engines are made on first use, importing this module does not load a database driver
+repo_factory = RepositoryFactory(config.DB_URL, on_engine=instrument_engine)
+async_repo_factory = AsyncRepositoryFactory(
+    config.DB_URL,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_pre_ping=config.DB_POOL_PRE_PING,
+    statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+    on_engine=instrument_engine,
+)
 root_dir = Path(config.ROOT_DIR).absolute()
-service = FSService(repo_factory, root_dir)
 redis_connection = redis.Redis(
     host=config.REDIS_HOST,
     port=config.REDIS_PORT,
@@ -16,3 +29,39 @@ redis_connection = redis.Redis(
     password=config.REDIS_PASS,
     decode_responses=True,
 )
+async_redis_connection = redis.asyncio.Redis(
+    host=config.REDIS_HOST,
+    port=config.REDIS_PORT,
+    username=config.REDIS_USER,
+    password=config.REDIS_PASS,
+    decode_responses=True,
+)
+listing_cache = ListingCache(config.LISTING_CACHE_SIZE, redis_connection, async_redis_connection)
+cache_collector.add('listing', listing_cache.entries)
+blob_cache = BlobCache(
+    config.BLOB_CACHE_SIZE,
+    max_file_size=config.BLOB_CACHE_MAX_FILE_SIZE,
+    admit_after=config.BLOB_CACHE_ADMIT_AFTER,
+    mmap_min_size=config.BLOB_CACHE_MMAP_MIN_SIZE,
+)
+cache_collector.add('blob', blob_cache)
+service = FSService(
+    async_repo_factory,
+    root_dir,
+    dedupe=config.DEDUPE,
+    listing_cache=listing_cache,
+    listing_page_size=config.LISTING_PAGE_SIZE,
+    compress=config.COMPRESS,
+    compress_min_size=config.COMPRESS_MIN_SIZE,
+    blob_cache=blob_cache,
+)
+upload_service = UploadService(service, root_dir)
+garbage_collector = GarbageCollector(
+    root_dir,
+    repo_factory,
+    grace_period=config.GC_GRACE_PERIOD,
+    rate=config.GC_RATE,
+    scan_rate=config.GC_SCAN_RATE,
+    batch_size=config.GC_BATCH_SIZE,
+    upload_ttl=config.UPLOAD_TTL,
+)
@@ -0,0 +1,31 @@
+from datetime import datetime
+from typing import List, Optional
+
+import msgspec
+
+
+class CreateUploadDto(msgspec.Struct):
+    # path of the file to create, its directory must exist
+    full_path: str
+    # expected total size, checked on completion when given
+    size: Optional[int] = None
+
+
+class PartDto(msgspec.Struct):
+    number: int
+    size: int
+
+
+class UploadDto(msgspec.Struct):
+    id: str
+    full_path: str
+    size: Optional[int] = None
+    created_at: Optional[datetime] = None
+    parts: List[PartDto] = []
+    # bytes received in parts 1..n without a gap, where a sequential client resumes
+    offset: int = 0
+
+
+class CompleteUploadDto(msgspec.Struct):
+    # part numbers to assemble in order, every received part if not given
+    parts: Optional[List[int]] = None
@@ -0,0 +1,42 @@
+from typing import Optional
+
+from litestar import get, post, put, delete, Request
+
+import config
+from fs.models import FileDto
+from singletons import upload_service
+from .models import CompleteUploadDto, CreateUploadDto, PartDto, UploadDto
+
+
+@post('/', status_code=201)
+async def create_upload(data: CreateUploadDto) -> UploadDto:
+    return await upload_service.create(data)
+
+
+@put('/{upload_id:str}/parts/{number:int}', request_max_body_size=config.UPLOAD_MAX_PART_SIZE)
+async def put_part(request: Request, upload_id: str, number: int) -> PartDto:
+    return await upload_service.put_part(upload_id, number, request.stream())
+
+
+@get('/{upload_id:str}')
+async def get_upload(upload_id: str) -> UploadDto:
+    return await upload_service.get(upload_id)
+
+
+@post('/{upload_id:str}/complete', status_code=201)
+async def complete_upload(upload_id: str, data: Optional[CompleteUploadDto] = None) -> FileDto:
+    return await upload_service.complete(upload_id, data)
+
+
+@delete('/{upload_id:str}', status_code=204)
+async def abort_upload(upload_id: str) -> None:
+    await upload_service.abort(upload_id)
+
+
+handlers = [
+    create_upload,
+    put_part,
+    get_upload,
+    complete_upload,
+    abort_upload,
+]
@@ -0,0 +1,181 @@
+"""
+Resumable uploads in numbered parts, in the manner of S3 multipart uploads.
+
+    POST   /upload                      {"full_path": "/dir/name", "size": 123} starts an upload
+    PUT    /upload/{id}/parts/{number}  the raw bytes of one part, parts may be sent in parallel or again
+    GET    /upload/{id}                 the parts received so far, and the offset to resume a sequential upload
+    POST   /upload/{id}/complete        assembles the parts into the file and registers it
+    DELETE /upload/{id}                 aborts the upload
+
+Parts are staged in `root_dir/.uploads/<id>/`. The state lives on disk only,
+so any worker can serve any request of an upload.
+"""
+import os
+import shutil
+import string
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+import msgspec
+from litestar.exceptions import HTTPException
+
+from fs.models import FileDto, utc_now
+from fs.service import FSService
+from fs.storage import hash_file
+from utils import run_io
+from .models import CompleteUploadDto, CreateUploadDto, PartDto, UploadDto
+
+
+class UploadMeta(msgspec.Struct):
+    full_path: str
+    size: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class UploadService:
+    max_parts = 10000
+
+    def __init__(self, fs_service: FSService, root_dir: Path):
+        self.fs_service = fs_service
+        self.storage = fs_service.storage
+        self.uploads_dir = root_dir / '.uploads'
+
+    def _upload_dir(self, upload_id: str) -> Path:
+        if len(upload_id) != 32 or not set(upload_id) <= set(string.hexdigits.lower()):
+            raise HTTPException(status_code=404)
+        return self.uploads_dir / upload_id
+
+    @staticmethod
+    def _read_meta(upload_dir: Path) -> UploadMeta:
+        try:
+            return msgspec.json.decode((upload_dir / 'meta.json').read_bytes(), type=UploadMeta)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+
+    @staticmethod
+    def _read_parts(upload_dir: Path) -> List[PartDto]:
+        parts = []
+        with os.scandir(upload_dir) as entries:
+            for entry in entries:
+                # parts being received are hidden until they are complete
+                if entry.name.startswith('.') or not entry.name.endswith('.part'):
+                    continue
+                parts.append(PartDto(number=int(entry.name[:-5]), size=entry.stat().st_size))
+        return sorted(parts, key=lambda part: part.number)
+
+    async def create(self, data: CreateUploadDto) -> UploadDto:
+        full_path = data.full_path.rstrip('/')
+        target_dir, _, name = full_path.rpartition('/')
+        if not name or (data.size is not None and data.size < 0):
+            raise HTTPException(status_code=400)
+        async with self.fs_service.get_session() as session:
+            if not await session.exists_by_path(target_dir or '/'):
+                raise HTTPException(status_code=400)
+
+        upload_id = uuid.uuid4().hex
+        meta = UploadMeta(full_path=full_path, size=data.size, created_at=utc_now())
+        upload_dir = self.uploads_dir / upload_id
+
+        def write_meta():
+            upload_dir.mkdir(parents=True)
+            (upload_dir / 'meta.json').write_bytes(msgspec.json.encode(meta))
+        await run_io(write_meta)
+        return UploadDto(id=upload_id, full_path=full_path, size=meta.size, created_at=meta.created_at)
+
+    async def put_part(self, upload_id: str, number: int, body: AsyncIterator[bytes]) -> PartDto:
+        """Store part `number` from the request body, replacing an earlier copy of it."""
+        if not 1 <= number <= self.max_parts:
+            raise HTTPException(status_code=400, detail=f'part numbers go from 1 to {self.max_parts}')
+        upload_dir = self._upload_dir(upload_id)
+        if not await run_io((upload_dir / 'meta.json').exists):
+            raise HTTPException(status_code=404)
+
+        tmp_path = upload_dir / f'.{number}.{uuid.uuid4().hex}'
+        size = 0
+        try:
+            f = await run_io(open, tmp_path, 'wb')
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        try:
+            async for chunk in body:
+                await run_io(f.write, chunk)
+                size += len(chunk)
+            await run_io(f.close)
+            await run_io(os.replace, tmp_path, upload_dir / f'{number}.part')
+        except FileNotFoundError:
+            # completed or aborted meanwhile
+            raise HTTPException(status_code=404)
+        finally:
+            f.close()
+            await run_io(lambda: tmp_path.unlink(missing_ok=True))
+        return PartDto(number=number, size=size)
+
+    async def get(self, upload_id: str) -> UploadDto:
+        upload_dir = self._upload_dir(upload_id)
+        meta = await run_io(self._read_meta, upload_dir)
+        parts = await run_io(self._read_parts, upload_dir)
+        offset = 0
+        for expected, part in enumerate(parts, start=1):
+            if part.number != expected:
+                break
+            offset += part.size
+        return UploadDto(
+            id=upload_id,
+            full_path=meta.full_path,
+            size=meta.size,
+            created_at=meta.created_at,
+            parts=parts,
+            offset=offset,
+        )
+
+    async def complete(self, upload_id: str, data: Optional[CompleteUploadDto] = None) -> FileDto:
+        """
+        Assemble the parts in order into one blob and register it as a single file.
+        On failure the parts stay, so the client can fix what is missing and complete again.
+        """
+        upload_dir = self._upload_dir(upload_id)
+        # taken over atomically, a concurrent complete or abort finds the upload gone
+        assembling_dir = self.uploads_dir / f'.{upload_id}'
+        try:
+            # touched first, jobs.gc ages uploads by mtime and must not take this one while it is assembled
+            await run_io(os.utime, upload_dir)
+            await run_io(os.rename, upload_dir, assembling_dir)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+
+        try:
+            meta = await run_io(self._read_meta, assembling_dir)
+            received = {part.number: part for part in await run_io(self._read_parts, assembling_dir)}
+            numbers = data.parts if data is not None and data.parts else sorted(received)
+            missing = [number for number in numbers if number not in received]
+            if not numbers or missing:
+                raise HTTPException(status_code=400, detail=f'missing parts {missing}')
+            size = sum(received[number].size for number in numbers)
+            if meta.size is not None and size != meta.size:
+                raise HTTPException(status_code=400, detail=f'{size} bytes received, {meta.size} expected')
+
+            tmp_path, size = await self.storage.assemble(assembling_dir / f'{number}.part' for number in numbers)
+            try:
+                # parts may be sent again or out of order, the hash is only known once assembled
+                content_hash = await run_io(hash_file, tmp_path)
+            except BaseException:
+                await self.storage.discard(tmp_path)
+                raise
+            target_dir, _, name = meta.full_path.rpartition('/')
+            dto = await self.fs_service.register_file(target_dir or '/', name, tmp_path, size, content_hash)
+        except BaseException:
+            await run_io(os.rename, assembling_dir, upload_dir)
+            raise
+        await run_io(shutil.rmtree, assembling_dir, True)
+        return dto
+
+    async def abort(self, upload_id: str) -> None:
+        upload_dir = self._upload_dir(upload_id)
+        aborted_dir = self.uploads_dir / f'.{upload_id}'
+        try:
+            await run_io(os.rename, upload_dir, aborted_dir)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        await run_io(shutil.rmtree, aborted_dir, True)
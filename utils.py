@@ -1,11 +1,34 @@
 import mimetypes
+import os
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Hashable, List, Mapping, Optional, Tuple
 
+from anyio import CapacityLimiter, to_thread
 from nacl.public import PrivateKey, SealedBox, PublicKey
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import config
+from metrics.collectors import FILE_READ_BYTES, FILE_READ_TIME
+
+# text formats common in root_dir that mimetypes does not know, or takes for something else
+for _mime_type, _extension in (
+        ('text/plain', '.log'),
+        ('application/yaml', '.yaml'),
+        ('application/yaml', '.yml'),
+        ('text/x-ssa', '.ass'),
+        ('text/x-ssa', '.ssa'),
+):
+    mimetypes.add_type(_mime_type, _extension)
 
 
 def get_mime_type(filename: str) -> str:
@@ -13,12 +36,295 @@ def get_mime_type(filename: str) -> str:
     return mime_type or 'application/octet-stream'
 
 
-async def file_streamer(file_path: Path) -> AsyncGenerator[bytes, None]:
-    """Streams a file from disk in chunks to minimize memory usage."""
-    chunk_size = 65536  # 64KB
-    with open(file_path, "rb") as f:
-        while chunk := f.read(chunk_size):
+io_limiter = None
+
+
+def get_io_limiter() -> CapacityLimiter:
+    """Thread pool capacity shared by all blocking file operations."""
+    global io_limiter
+    if io_limiter:
+        return io_limiter
+    io_limiter = CapacityLimiter(config.IO_THREADS)
+    return io_limiter
+
+
+async def run_io(func, *args):
+    return await to_thread.run_sync(func, *args, limiter=get_io_limiter())
+
+
+async def file_streamer(
+        file_path: Path,
+        start: int = 0,
+        end: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+) -> AsyncGenerator[bytes, None]:
+    """Streams a file from disk in chunks to minimize memory usage.
+
+    When given, `start` and `end` (inclusive) limit the stream to that byte range.
+    Reads run on the io thread pool so the event loop never blocks on disk,
+    and the chunk size doubles up to STREAM_MAX_CHUNK_SIZE as the stream goes on,
+    so short reads stay cheap while long downloads need fewer round trips.
+    """
+    chunk_size = chunk_size or config.STREAM_CHUNK_SIZE
+    max_chunk_size = max(chunk_size, config.STREAM_MAX_CHUNK_SIZE)
+    remaining = None if end is None else end - start + 1
+
+    fd = await run_io(os.open, file_path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, start, remaining or 0, os.POSIX_FADV_SEQUENTIAL)
+        offset = start
+        while remaining is None or remaining > 0:
+            read_size = chunk_size if remaining is None else min(chunk_size, remaining)
+            with FILE_READ_TIME.time():
+                chunk = await run_io(os.pread, fd, read_size, offset)
+            FILE_READ_BYTES.inc(len(chunk))
+            if not chunk:
+                break
+            offset += len(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
             yield chunk
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+    finally:
+        os.close(fd)
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range_header(header: str, size: int, max_ranges: int = 16) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range` header against a resource of `size` bytes.
+    Returns a list of inclusive (start, end) pairs, sorted and coalesced,
+    or None if the header is malformed and should be ignored.
+    Raises RangeNotSatisfiable if no range overlaps the resource.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # suffix range, last N bytes
+            if not last:
+                return None
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > max_ranges:
+        # too many disjoint ranges, collapse into one covering span
+        merged = [(merged[0][0], merged[-1][1])]
+    return merged
+
+
+def http_date(timestamp: float) -> str:
+    return format_datetime(datetime.fromtimestamp(int(timestamp), tz=timezone.utc), usegmt=True)
+
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison of `etag` against an `If-None-Match` list."""
+    if header.strip() == '*':
+        return True
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+
+    return opaque(etag) in set(map(opaque, header.split(',')))
+
+
+def is_not_modified(headers: Mapping[str, str], etag: str, last_modified: Optional[datetime]) -> bool:
+    """
+    Whether a conditional GET can be answered with 304.
+    `If-None-Match` takes precedence over `If-Modified-Since` when both are sent.
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(last_modified.timestamp()) <= int(since.timestamp())
+    return False
+
+
+def multipart_ranges(
+        file_path: Path,
+        ranges: List[Tuple[int, int]],
+        size: int,
+        media_type: str,
+        boundary: str,
+) -> Tuple[int, AsyncGenerator[bytes, None]]:
+    """
+    Build a multipart/byteranges body for `ranges` of `file_path`.
+    Returns the exact content length together with the body stream.
+    """
+    heads = [
+        (f'\r\n--{boundary}\r\n'
+         f'Content-Type: {media_type}\r\n'
+         f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+        for start, end in ranges
+    ]
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    length = sum(len(head) for head in heads) + sum(end - start + 1 for start, end in ranges) + len(tail)
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        for head, (start, end) in zip(heads, ranges):
+            yield head
+            async for chunk in file_streamer(file_path, start, end):
+                yield chunk
+        yield tail
+
+    return length, stream()
+
+
+class LRUCache:
+    """
+    Thread safe mapping bounded to `maxsize` entries, evicting the least recently used.
+    Entries expire after `ttl` seconds when given.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def pop_where(self, predicate) -> int:
+        """Drop every entry whose value satisfies `predicate`, returns how many were dropped."""
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on `path`, shared by the processes of one host.
+    Held until `release` or the end of the process. Does not lock where fcntl is missing.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if fcntl is None or self._fd is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
 
 
 def create_key(overwrite=False):
@@ -43,8 +349,12 @@ def create_key(overwrite=False):
     hand_key = str(uuid.uuid4()).replace('-', '')
     hand_path.write_text(hand_key)
 
+    global decoder, handshake
+    decoder, handshake = None, None
+
 
 decoder = None
+handshake = None
 
 
 def get_decoder():
@@ -63,9 +373,13 @@ def get_decoder():
 
 
 def get_handshake():
+    global handshake
+    if handshake:
+        return handshake
     key_path = Path(config.KEY_DIR)
     hand_path = key_path / 'handshake'
-    return hand_path.read_text()
+    handshake = hand_path.read_text()
+    return handshake
 
 
 def create_test_message(message):